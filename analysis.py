@@ -1,23 +1,163 @@
+import numpy as np
 import matplotlib.pyplot as plt
 
 from pathlib import Path
-from operator import attrgetter
-from typing import Sequence, Callable
+from functools import reduce
+from itertools import repeat
+from dataclasses import dataclass
+from concurrent.futures import ProcessPoolExecutor
+from typing import Sequence, Union, Dict, Tuple, Iterable
 
-from cloudchamber.particle import Particle
+from cloudchamber.particle import Particle, ParticleTable
 
-from fs import load_particles, CSV_PATH
+from fs import load_table, iter_columns, get_csvs, CSV_PATH
 
 _HISTOGRAMS = (
-    (lambda particle: particle.start.timestamp, "Track Appearance Timestamp [sec]"),
-    (attrgetter("length"), "Track Length [px]"),
-    (attrgetter("width"), "Track Width [px]"),
-    (attrgetter("angle"), "Track Angle [deg]"),
-    (attrgetter("curvature"), "Track Curvature [1/px]"),
-    (attrgetter("intensity"), "Mean Track Intensity [0-255]"),
+    ("start_time", "Track Appearance Timestamp [sec]"),
+    ("length", "Track Length [px]"),
+    ("width", "Track Width [px]"),
+    ("angle", "Track Angle [deg]"),
+    ("curvature", "Track Curvature [1/px]"),
+    ("intensity", "Mean Track Intensity [0-255]"),
 )
 
 
+# The bins of the dataset-wide histograms, which are the same for all the files so their histograms can be merged:
+# fixed edges for bounded columns, or a number of bins spanning the values of the whole dataset
+_BINS = {
+    "start_time": 120,
+    "length": 200,
+    "width": 200,
+    "angle": np.linspace(-90, 180, 55),
+    "curvature": 200,
+    "intensity": np.linspace(0, 256, 129),
+}
+_LENGTH_WIDTH = "length_width"
+_LENGTH_WIDTH_BINS = (100, 50)
+
+
+@dataclass
+class Histogram:
+    """
+    A histogram with fixed bins, which is accumulated in chunks and merged with histograms of the same bins.
+
+    edges (Tuple[ndarray, ...]): The bin edges of each dimension
+    counts (ndarray): The count of each bin
+    outside (int): How many values were outside the bins, and so aren't counted
+    """
+    edges: Tuple[np.ndarray, ...]
+    counts: np.ndarray
+    outside: int = 0
+
+    @classmethod
+    def empty(cls, *edges: np.ndarray) -> "Histogram":
+        return cls(edges, np.zeros([len(dimension) - 1 for dimension in edges], dtype=np.int64))
+
+    def add(self, *values: np.ndarray) -> None:
+        """
+        Counts values (an array for each dimension), ignoring missing (NaN) values.
+        """
+        finite = np.logical_and.reduce([np.isfinite(dimension) for dimension in values])
+        counts = np.histogramdd(np.stack([dimension[finite] for dimension in values], axis=1), self.edges)[0]
+        self.counts += counts.astype(np.int64)
+        self.outside += int(finite.sum() - counts.sum())
+
+    def merge(self, other: "Histogram") -> "Histogram":
+        self.counts += other.counts
+        self.outside += other.outside
+        return self
+
+
+# The histograms of each source of videos (the directory of the videos, e.g. "Background" or "Rod")
+Histograms = Dict[str, Dict[str, Histogram]]
+# The minimum and maximum of the values of each column
+Ranges = Dict[str, Tuple[float, float]]
+# The bin edges of each histogram
+Edges = Dict[str, Tuple[np.ndarray, ...]]
+
+
+def column_ranges(path: Path) -> Ranges:
+    """
+    The ranges of the columns which are binned by the values, in the particles of a single file (read in chunks).
+    """
+    columns = [column for column, bins in _BINS.items() if np.isscalar(bins)]
+    ranges = {}
+    for chunk in iter_columns(path, columns):
+        for column in columns:
+            values = chunk[column][np.isfinite(chunk[column])]
+            if len(values):
+                ranges = merge_ranges(ranges, {column: (float(values.min()), float(values.max()))})
+    return ranges
+
+
+def merge_ranges(total: Ranges, partial: Ranges) -> Ranges:
+    merged = dict(total)
+    for column, (low, high) in partial.items():
+        total_low, total_high = merged.get(column, (low, high))
+        merged[column] = (min(low, total_low), max(high, total_high))
+    return merged
+
+
+def _edges(bins: Union[int, np.ndarray], value_range: Tuple[float, float] = None) -> np.ndarray:
+    if not np.isscalar(bins):
+        return bins
+    low, high = value_range or (0, 1)
+    return np.linspace(low, high if high > low else low + 1, bins + 1)
+
+
+def dataset_edges(ranges: Ranges) -> Edges:
+    """
+    The bin edges of the dataset-wide histograms, for the ranges of the values in the whole dataset.
+    """
+    return {**{column: (_edges(bins, ranges.get(column)),) for column, bins in _BINS.items()},
+            _LENGTH_WIDTH: (_edges(_LENGTH_WIDTH_BINS[0], ranges.get("length")),
+                            _edges(_LENGTH_WIDTH_BINS[1], ranges.get("width")))}
+
+
+def histogram_file(path: Path, edges: Edges) -> Histograms:
+    """
+    Histograms the particles of a single file with the given bins, reading only the needed columns, in chunks.
+    """
+    histograms = {}
+    for chunk in iter_columns(path, list(_BINS)):
+        videos, rows_videos = np.unique(chunk["video"], return_inverse=True)
+        sources = np.array([Path(video).parent.name for video in videos])[rows_videos]
+        for source in np.unique(sources).tolist():
+            rows = sources == source
+            source_histograms = histograms.setdefault(source, {name: Histogram.empty(*dimensions)
+                                                               for name, dimensions in edges.items()})
+            for column in _BINS:
+                source_histograms[column].add(chunk[column][rows])
+            source_histograms[_LENGTH_WIDTH].add(chunk["length"][rows], chunk["width"][rows])
+    return histograms
+
+
+def merge_histograms(total: Histograms, partial: Histograms) -> Histograms:
+    for source, histograms in partial.items():
+        if source in total:
+            for name, histogram in histograms.items():
+                total[source][name].merge(histogram)
+        else:
+            total[source] = histograms
+    return total
+
+
+def aggregate_histograms(paths: Iterable[Path] = None, workers: int = None) -> Histograms:
+    """
+    Dataset-wide histograms of the stored particles (of all the CSVs by default), split by the source of the videos.
+    Each file is histogrammed in a worker process (see `histogram_file`), and only the histograms are kept,
+    so the memory doesn't grow with the dataset.
+    The files are read twice: first to find the ranges of the values, so the bins of all the files span the dataset.
+    """
+    paths = get_csvs() if paths is None else list(paths)
+    total = {}
+    with ProcessPoolExecutor(workers) as executor:
+        edges = dataset_edges(reduce(merge_ranges, executor.map(column_ranges, paths), {}))
+        for partial in executor.map(histogram_file, paths, repeat(edges)):
+            merge_histograms(total, partial)
+    return total
+
+
 def _format_title(label: str) -> str:
     title = " ".join(label.replace("Track ", "").split()[:-1])
     return f"{title} Histogram"
@@ -27,25 +167,43 @@ def _format_filename(label: str) -> str:
     return _format_title(label).replace(" ", "_")
 
 
-def _plot_hist(particles: Sequence[Particle], attr: Callable, label: str,
-               save_path: str = None, show: bool = True) -> None:
+def _as_table(particles: Union[Sequence[Particle], ParticleTable]) -> ParticleTable:
+    return particles if isinstance(particles, ParticleTable) else ParticleTable.from_particles(particles)
+
+
+def _outside_note(outside: int) -> str:
+    return f"\n({outside} particles outside the bins)" if outside else ""
+
+
+def _plot_counts(counts: np.ndarray, edges: np.ndarray, label: str, prefix: str = None, outside: int = 0,
+                 save_path: str = None, show: bool = True) -> None:
     fig = plt.figure()
-    plt.hist([attr(particle) for particle in particles], bins="auto")
+    # Drawing the bins as a single filled outline is much faster than a bar per bin (like plt.hist does)
+    plt.stairs(counts, edges, fill=True)
     plt.xlabel(label)
     plt.ylabel("No. Particles")
-    title = _format_title(label)
-    plt.title(title)
+    title = f"{prefix} {_format_title(label)}" if prefix else _format_title(label)
+    plt.title(title + _outside_note(outside))
     plt.grid()
     if save_path:
         print(f"Saving {title}")
         fig.savefig(save_path)
     if show:
         fig.show()
+    else:
+        plt.close(fig)
+
+
+def _plot_hist(table: ParticleTable, column: str, label: str,
+               save_path: str = None, show: bool = True) -> None:
+    values = table[column]
+    _plot_counts(*np.histogram(values[np.isfinite(values)], bins="auto"), label, save_path=save_path, show=show)
 
 
-def plot_hist_2d(particles: Sequence[Particle]) -> None:
+def plot_hist_2d(particles: Union[Sequence[Particle], ParticleTable]) -> None:
+    table = _as_table(particles)
     fig = plt.figure()
-    plt.hist2d(*zip(*((particle.length, particle.width) for particle in particles)), bins=40)
+    plt.hist2d(table["length"], table["width"], bins=40)
     # plt.xlabel(label)
     # plt.ylabel("No. Particles")
     # title = _format_title(label)
@@ -57,13 +215,42 @@ def plot_hist_2d(particles: Sequence[Particle]) -> None:
     fig.show()
 
 
-def plot_histograms(particles: Sequence[Particle],
+def plot_histograms(particles: Union[Sequence[Particle], ParticleTable],
                     save_dir: Path = None, show: bool = True) -> None:
+    table = _as_table(particles)
+    table.backfill_features()
     for hist in _HISTOGRAMS:
-        _plot_hist(particles, *hist, show=show,
+        _plot_hist(table, *hist, show=show,
                    save_path=(save_dir / _format_filename(hist[1])).with_suffix(".svg") if save_dir else None)
 
 
+def plot_aggregated_histograms(histograms: Histograms, save_dir: Path = None, show: bool = True) -> None:
+    """
+    Plots the dataset-wide histograms (see `aggregate_histograms`) of each source of videos.
+    """
+    for source, source_histograms in sorted(histograms.items()):
+        for column, label in _HISTOGRAMS:
+            histogram = source_histograms[column]
+            save_path = (save_dir / f"{source}_{_format_filename(label)}.svg") if save_dir else None
+            _plot_counts(histogram.counts, histogram.edges[0], label, source, histogram.outside,
+                         save_path=save_path, show=show)
+        histogram = source_histograms[_LENGTH_WIDTH]
+        fig = plt.figure()
+        plt.pcolormesh(*histogram.edges, histogram.counts.T)
+        plt.xlabel("Track Length [px]")
+        plt.ylabel("Track Width [px]")
+        title = f"{source} Length-Width Histogram"
+        plt.title(title + _outside_note(histogram.outside))
+        plt.colorbar(label="No. Particles")
+        if save_dir:
+            print(f"Saving {title}")
+            fig.savefig(save_dir / f"{title.replace(' ', '_')}.svg")
+        if show:
+            fig.show()
+        else:
+            plt.close(fig)
+
+
 if __name__ == '__main__':
-    # plot_histograms(load_particles(CSV_PATH / "20240109_122031-full.csv"))
-    plot_hist_2d(load_particles(CSV_PATH / "20240109_122031-full.csv"))
+    # plot_histograms(load_table(CSV_PATH / "20240109_122031-full.csv"))
+    plot_hist_2d(load_table(CSV_PATH / "20240109_122031-full.csv"))
@@ -0,0 +1,188 @@
+import os
+import csv
+import socket
+from time import time
+from uuid import uuid4
+from pathlib import Path
+from threading import Event, Thread
+from dataclasses import dataclass, asdict
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import List, Iterable, Optional, Iterator
+
+from bettercv.video import Video
+
+from cloudchamber.config import Config
+from cloudchamber.detection import analyze_video, can_resume
+
+from fs import get_bg_videos, get_rod_videos, save_particles, has_particles, CSV_PATH
+
+# A lease that was not refreshed for this long is considered abandoned (e.g. its machine crashed)
+LEASE_TIMEOUT = 10 * 60
+LEASE_HEARTBEAT = 60
+
+
+@dataclass(frozen=True)
+class Job:
+    """
+    A segment of a video to run detection on.
+
+    video (Path): The path to the video file
+    start (int): The start of the segment, in seconds
+    duration (int): The duration of the segment, in seconds (None for the rest of the video)
+    """
+    video: Path
+    start: int = 0
+    duration: Optional[int] = None
+
+    @property
+    def stop(self) -> Optional[int]:
+        return self.start + self.duration if self.duration else None
+
+    @property
+    def csv_path(self) -> Path:
+        if not self.start and not self.duration:
+            return CSV_PATH / self.video.with_suffix(".csv").name
+        return CSV_PATH / f"{self.video.stem}-{self.start}-{self.stop or 'end'}.csv"
+
+    @property
+    def lease_path(self) -> Path:
+        return self.csv_path.with_suffix(".lease")
+
+    def length(self) -> float:
+        """
+        The length of the segment in seconds, used to schedule the longest jobs first.
+        """
+        if self.duration:
+            return self.duration
+        with Video(self.video) as video:
+            return video.duration.total_seconds() - self.start
+
+
+def all_videos() -> List[Job]:
+    return [Job(path) for path in get_bg_videos() + get_rod_videos()]
+
+
+def load_manifest(path: Path) -> List[Job]:
+    """
+    Reads jobs from a CSV manifest with a `video,start,duration` header.
+    The start and duration are optional, and relative video paths are resolved against the manifest's directory.
+    """
+    with open(path, newline="") as manifest:
+        return [Job(path.parent / row["video"],
+                    int(row.get("start") or 0),
+                    int(row["duration"]) if row.get("duration") else None)
+                for row in csv.DictReader(manifest)]
+
+
+def _lease_owner() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _is_stale(lease: Path) -> bool:
+    try:
+        return time() - lease.stat().st_mtime > LEASE_TIMEOUT
+    except FileNotFoundError:
+        return True
+
+
+def acquire_lease(lease: Path) -> bool:
+    """
+    Atomically claims a lease file, so that no other process (on this machine or another one sharing
+    the filesystem) works on the same job. Abandoned leases are taken over.
+    """
+    try:
+        fd = os.open(lease, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        if not _is_stale(lease):
+            return False
+        # Move the stale lease aside rather than deleting it: a rename is atomic, so when several workers
+        # take it over at once only one of them moves it, and the others compete for the new lease below
+        moved = lease.with_name(f"{lease.name}.{uuid4().hex}")
+        try:
+            os.rename(lease, moved)
+        except FileNotFoundError:
+            return acquire_lease(lease)
+        try:
+            if not _is_stale(moved):
+                # Another worker took over between the check and the rename, so this is its fresh lease
+                try:
+                    os.link(moved, lease)
+                except FileExistsError:
+                    pass
+                return False
+        finally:
+            moved.unlink(missing_ok=True)
+        return acquire_lease(lease)
+    with os.fdopen(fd, "w") as file:
+        file.write(_lease_owner())
+    return True
+
+
+def release_lease(lease: Path) -> None:
+    # A lease which went stale might have been taken over by another worker since, and is then not ours to remove
+    try:
+        if lease.read_text() == _lease_owner():
+            lease.unlink()
+    except FileNotFoundError:
+        pass
+
+
+@contextmanager
+def _heartbeat(lease: Path) -> Iterator[None]:
+    """
+    Keeps refreshing the lease while the job is running, so it is not mistaken for an abandoned one.
+    """
+    done = Event()
+
+    def beat() -> None:
+        while not done.wait(LEASE_HEARTBEAT):
+            lease.touch()
+
+    thread = Thread(target=beat, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        done.set()
+        thread.join()
+
+
+def run_job(job: Job, config: Config) -> Optional[int]:
+    """
+    Runs detection on a single job, unless it is already claimed by someone else or already done.
+
+    Returns:
+        The number of detected particles, or None if the job was skipped
+    """
+    if not acquire_lease(job.lease_path):
+        return None
+    try:
+        # Check again after claiming, since another worker might have finished it in the meantime
+        if has_particles(job.csv_path, config):
+            return None
+        with _heartbeat(job.lease_path):
+            # Resumable (if the config allows it), so a job taken over from a crashed worker continues where it stopped
+            checkpoint = job.csv_path.with_suffix(".checkpoint") if can_resume(config) else None
+            particles = analyze_video(job.video, job.start, job.stop, checkpoint, **asdict(config))
+        save_particles(particles, job.csv_path, config)
+        return len(particles)
+    finally:
+        release_lease(job.lease_path)
+
+
+def detect_all(jobs: Iterable[Job], workers: int = None, **config) -> None:
+    config = Config.merge(config)
+    pending = [job for job in jobs if not has_particles(job.csv_path, config)]
+    pending.sort(key=Job.length, reverse=True)
+    print(f"Running {len(pending)} jobs")
+    with ProcessPoolExecutor(workers) as executor:
+        futures = {executor.submit(run_job, job, config): job for job in pending}
+        for future in as_completed(futures):
+            try:
+                count = future.result()
+                status = "skipped" if count is None else f"found {count} particles"
+            except Exception as error:
+                # One broken video should not bring down the whole batch
+                status = f"failed ({error!r})"
+            print(f"{futures[future].csv_path.name}: {status}")
@@ -0,0 +1,230 @@
+import json
+import resource
+import subprocess
+import argparse as ap
+import multiprocessing as mp
+from time import perf_counter
+from pathlib import Path
+from functools import partial
+from dataclasses import asdict, replace
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Dict, List, Sequence, Tuple
+
+import numpy as np
+
+from bettercv.video import Video, Frame
+from bettercv.contours import find_contours, join_close_contours
+
+from cloudchamber.config import Config
+from cloudchamber.particle import Particle
+from cloudchamber.tracking import Tracker
+from cloudchamber.bg_subtraction import subtract_bg
+from cloudchamber.processing import preprocess, smooth, Preprocessor
+from cloudchamber.detection import analyze_video, find_prominent_contours, join_close, retain_track_like
+
+from synthetic import TrackSpec, load_ground_truth
+
+BG_METHODS = ("mog2", "avg", "ema", "median", "replace")
+
+# A report of a single benchmark, e.g. {"frames": 300, "fps": 512.3, "peak_rss_mb": 210.5}
+Result = Dict[str, Any]
+
+
+def _run_preprocess(frames: Sequence[Frame], config: Config) -> None:
+    for frame in frames:
+        preprocess(frame, config)
+
+
+def _run_fused_preprocess(frames: Sequence[Frame], config: Config) -> None:
+    preprocessor = Preprocessor(frames[0].image.shape, config)
+    for frame in frames:
+        preprocessor(frame)
+
+
+def _run_smooth(sources: Sequence[Frame], config: Config) -> None:
+    for source in sources:
+        smooth(source, config)
+
+
+def _run_subtract_bg(smoothed: Sequence[Frame], config: Config, method: str) -> None:
+    for _ in subtract_bg(iter(smoothed), replace(config, bg_method=method)):
+        pass
+
+
+def _run_find_contours(binaries: Sequence[Frame], config: Config) -> None:
+    for binary in binaries:
+        find_contours(binary.image, external_only=True)
+
+
+def _run_join_close_contours(contours: Sequence[Sequence], config: Config) -> None:
+    for frame_contours in contours:
+        join_close_contours(frame_contours, config.dist_close)
+
+
+def _run_track(detections: Sequence[Tuple[Frame, Sequence]], config: Config) -> None:
+    tracker = Tracker(config.track_distance, keep_history=config.keep_track_history)
+    for source, contours in detections:
+        tracker.update(contours, source)
+    tracker.flush()
+
+
+# Each stage runs on the outputs of the stages before it (see `_stage_inputs`)
+STAGES: Dict[str, Callable[[Sequence, Config], None]] = {
+    "preprocess": _run_preprocess,
+    "fused_preprocess": _run_fused_preprocess,
+    "smooth": _run_smooth,
+    **{f"subtract_bg:{method}": partial(_run_subtract_bg, method=method) for method in BG_METHODS},
+    "find_contours": _run_find_contours,
+    "join_close_contours": _run_join_close_contours,
+    "track": _run_track,
+}
+
+
+def _stage_inputs(stage: str, frames: List[Frame], config: Config) -> Sequence:
+    """
+    Computes the inputs of a stage by running the stages before it (with the config's BG method).
+    """
+    if stage in ("preprocess", "fused_preprocess"):
+        return frames
+    sources = [preprocess(frame, config) for frame in frames]
+    if stage == "smooth":
+        return sources
+    smoothed = [smooth(source, config) for source in sources]
+    if stage.startswith("subtract_bg"):
+        return smoothed
+    binaries = list(subtract_bg(iter(smoothed), config))
+    if stage == "find_contours":
+        return binaries
+    contours = [find_prominent_contours(binary, config.min_contour_size) for binary in binaries]
+    if stage == "join_close_contours":
+        return contours
+    sources = {source.ref.index: source for source in sources}
+    return [(sources[binary.ref.index],
+             tuple(retain_track_like(join_close(frame_contours, binary.image.shape, config), config)))
+            for binary, frame_contours in zip(binaries, contours)]
+
+
+def _fused_mismatches(frames: Sequence[Frame], config: Config) -> int:
+    """
+    The number of frames which the fused preprocessing (`Preprocessor`) doesn't preprocess exactly like `preprocess`.
+    """
+    preprocessor = Preprocessor(frames[0].image.shape, config)
+    return sum(not np.array_equal(preprocess(frame, config).image, preprocessor(frame).image) for frame in frames)
+
+
+def _peak_rss_mb() -> float:
+    # Linux reports the peak RSS in KB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def benchmark_stage(stage: str, path: Path, count: int, config: Config) -> Result:
+    """
+    Times a single stage on the first frames of a video, which are read (and run through the previous stages)
+    into memory first. The peak RSS is of the whole process, so it includes these inputs.
+    The fused preprocessing is also checked against the plain one.
+    """
+    with Video(path) as video:
+        frames = list(video.iter_frames(stop=count))
+    inputs = _stage_inputs(stage, frames, config)
+    start_time = perf_counter()
+    STAGES[stage](inputs, config)
+    seconds = perf_counter() - start_time
+    result = {"frames": len(inputs), "fps": len(inputs) / seconds, "peak_rss_mb": _peak_rss_mb()}
+    if stage == "fused_preprocess":
+        result["mismatches"] = _fused_mismatches(inputs, config)
+    return result
+
+
+def _is_match(particle: Particle, track: TrackSpec, config: Config) -> bool:
+    """
+    Whether a particle was detected while the track was visible, close to it.
+    The track is moved into the coordinates of the preprocessed frames, which the particles are in.
+    """
+    if not (particle.start.index < track.stop and track.start <= particle.end.index):
+        return False
+    top, _, left, _ = config.crop_box
+    points = track.points() * config.scale_factor - (left, top)
+    centroid = particle.snapshot.contour.centroid
+    return np.hypot(*(points - (centroid.x, centroid.y)).T).min() < config.track_distance
+
+
+def score_detection(particles: Sequence[Particle], tracks: Sequence[TrackSpec], config: Config) -> Result:
+    """
+    The recall (the part of the detectable tracks which match a particle)
+    and the precision (the part of the particles which match a track).
+    Tracks which are too short-lived to pass the track filtering are not detectable.
+    """
+    detectable = [track for track in tracks if track.lifetime - 1 > config.min_track_length]
+    matched = [any(_is_match(particle, track, config) for particle in particles) for track in detectable]
+    genuine = [any(_is_match(particle, track, config) for track in tracks) for particle in particles]
+    return {"tracks": len(detectable),
+            "particles": len(particles),
+            "recall": sum(matched) / len(detectable) if detectable else 1,
+            "precision": sum(genuine) / len(particles) if particles else 1}
+
+
+def benchmark_video(path: Path, config: Config) -> Result:
+    """
+    Times `analyze_video` on a whole synthetic video (including decoding), and scores it against the ground truth.
+    """
+    start_time = perf_counter()
+    particles = analyze_video(path, **asdict(config))
+    seconds = perf_counter() - start_time
+    with Video(path) as video:
+        frames = video.frame_num
+    return {"frames": frames, "fps": frames / seconds, "peak_rss_mb": _peak_rss_mb(),
+            **score_detection(particles, load_ground_truth(path), config)}
+
+
+def _in_fresh_process(function: Callable, *args) -> Result:
+    # A new process for each benchmark, so their peak RSS is separate
+    with ProcessPoolExecutor(1, mp_context=mp.get_context("spawn")) as executor:
+        return executor.submit(function, *args).result()
+
+
+def _commit() -> str:
+    result = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                            cwd=Path(__file__).parent)
+    return result.stdout.strip() or None
+
+
+def run_benchmarks(path: Path, count: int, config: Config) -> Dict[str, Any]:
+    report = {"commit": _commit(), "video": str(path), "config": asdict(config), "stages": {}}
+    for stage in STAGES:
+        report["stages"][stage] = _in_fresh_process(benchmark_stage, stage, path, count, config)
+        mismatches = report["stages"][stage].get("mismatches")
+        print(f"{stage}: {report['stages'][stage]['fps']:.1f} fps"
+              + (f" ({mismatches} mismatches)" if mismatches is not None else ""))
+    report["analyze_video"] = _in_fresh_process(benchmark_video, path, config)
+    print(f"analyze_video: {report['analyze_video']}")
+    return report
+
+
+def compare_reports(old: Dict[str, Any], new: Dict[str, Any]) -> None:
+    results = {**old["stages"], "analyze_video": old["analyze_video"]}
+    for name, result in {**new["stages"], "analyze_video": new["analyze_video"]}.items():
+        if name in results:
+            print(f"{name}: {result['fps'] / results[name]['fps']:.2f}x fps, "
+                  f"{result['peak_rss_mb'] - results[name]['peak_rss_mb']:+.1f} MB peak RSS")
+    print(f"recall: {old['analyze_video']['recall']:.3f} -> {new['analyze_video']['recall']:.3f}, "
+          f"precision: {old['analyze_video']['precision']:.3f} -> {new['analyze_video']['precision']:.3f}")
+
+
+def parse_args() -> ap.Namespace:
+    parser = ap.ArgumentParser(description="Benchmark the detection stages on a synthetic video (see synthetic.py)")
+    parser.add_argument("video", type=Path)
+    parser.add_argument("--frames", type=int, default=300, help="The number of frames to benchmark each stage on")
+    parser.add_argument("--config", type=Path, help="A JSON of config fields to override")
+    parser.add_argument("--output", type=Path, help="Where to save the JSON report")
+    parser.add_argument("--compare", type=Path, help="A previous JSON report to compare with")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    overrides = json.loads(args.config.read_text()) if args.config else {}
+    report = run_benchmarks(args.video, args.frames, Config.merge({"prints": False, **overrides}))
+    if args.output:
+        args.output.write_text(json.dumps(report, indent=2))
+    if args.compare:
+        compare_reports(json.loads(args.compare.read_text()), report)
@@ -3,13 +3,16 @@ import numpy as np
 from random import shuffle
 from numpy import ndarray, vstack
 from dataclasses import dataclass
-from typing import Sequence, Tuple
+from typing import Sequence, Tuple, List, Dict
 from functools import cached_property
 
 from .types import Position, Image
-from .image import bgr, is_grayscale, grayscale
+from .image import bgr, is_grayscale, grayscale, MAX_PIXEL_VALUE
 from .colors import Color, max_sv, max_spaced_hues
 
+# Parabola fits whose normal equations are worse conditioned than this are redone with np.polyfit (see `fit_parabolas`)
+MAX_FIT_CONDITION = 1e8
+
 
 @dataclass
 class Contour:
@@ -74,37 +77,143 @@ class Contour:
         return np.polyfit(self.points[:, 0, 0], self.points[:, 0, 1], deg)
 
     def is_close_to(self, other: "Contour", distance: float, jump: int = 10) -> bool:
-        return any(cv.norm(p1 - p2) < distance
-                   for p1 in self.points[::jump]
-                   for p2 in other.points[::jump])
+        return _points_close(self.points[::jump], other.points[::jump], distance)
 
     def create_mask(self, shape: Tuple[int, ...]) -> Image:
         return grayscale(draw_contours(np.zeros(shape, np.uint8), [self], (255, 255, 255), fill=True))
 
+    def mean_value(self, image: Image) -> float:
+        """
+        The mean pixel value of the image inside the contour.
+        Only the bounding rectangle of the contour is masked, rather than the whole image.
+        """
+        x, y, width, height = self.bounding_rect
+        roi = image[y:y + height, x:x + width]
+        mask = np.zeros(roi.shape[:2], np.uint8)
+        cv.drawContours(mask, [self.points], 0, MAX_PIXEL_VALUE, -1, offset=(-x, -y))
+        return cv.mean(roi, mask)[0]
+
 
 def join_contours(contours: Sequence[Contour]) -> Contour:
     return Contour(vstack([contour.points for contour in contours])).convex_hull()
 
 
-def join_close_contours(contours: Sequence[Contour], closeness: int) -> Sequence[Contour]:
-    groups = []
-    for i, c1 in enumerate(contours):
-        close_indices = [j for j, c2 in tuple(enumerate(contours))[i + 1:]
-                         if c2.is_close_to(c1, closeness)]
-        new_group = set(close_indices + [i])
-        disjoint_groups = []
-        for group in groups:
-            if new_group.intersection(group):
-                new_group = new_group.union(group)
-            else:
-                disjoint_groups.append(group)
-        groups = disjoint_groups + [new_group]
-    return [join_contours([contours[index] for index in group]) for group in groups]
+def fit_parabolas(points: ndarray, offsets: ndarray) -> ndarray:
+    """
+    Fits a parabola to the points of each of many contours at once, like `Contour.fit(2)` does for a single contour.
+    Solves the least squares normal equations of all the contours together, in coordinates centered on each contour.
+
+    Args:
+        points: The points of all the contours, concatenated into an array of shape (n, 2)
+        offsets: Where the points of each contour start, followed by the total number of points
+
+    Returns:
+        The coefficients of each contour's parabola (highest power first), as an array of shape (contours, 3)
+    """
+    coefficients = np.empty((len(offsets) - 1, 3))
+    if not len(coefficients):
+        return coefficients
+    starts, counts = offsets[:-1], np.diff(offsets)
+    x, y = points[:, 0].astype(np.float64), points[:, 1].astype(np.float64)
+    center = np.add.reduceat(x, starts) / counts
+    x -= np.repeat(center, counts)
+    scale = np.maximum.reduceat(np.abs(x), starts)
+    scale[scale == 0] = 1
+    x /= np.repeat(scale, counts)
+    squares = x * x
+    powers = np.stack([np.ones_like(x), x, squares, squares * x, squares * squares], axis=1)
+    sums = np.add.reduceat(powers, starts)
+    normal = sums[:, np.arange(3)[:, np.newaxis] + np.arange(3)]
+    moments = np.add.reduceat(powers[:, :3] * y[:, np.newaxis], starts)
+    solvable = np.linalg.cond(normal) < MAX_FIT_CONDITION
+    # The fit in the centered coordinates, lowest power first
+    c0, c1, c2 = np.linalg.solve(normal[solvable], moments[solvable][..., np.newaxis])[..., 0].T
+    center, scale = center[solvable], scale[solvable]
+    coefficients[solvable] = np.stack([c2 / scale ** 2,
+                                       c1 / scale - 2 * c2 * center / scale ** 2,
+                                       c0 - c1 * center / scale + c2 * center ** 2 / scale ** 2], axis=1)
+    for index in np.flatnonzero(~solvable).tolist():
+        contour = points[offsets[index]:offsets[index + 1]]
+        coefficients[index] = np.polyfit(contour[:, 0], contour[:, 1], 2)
+    return coefficients
+
+
+def _points_close(points1: ndarray, points2: ndarray, distance: float) -> bool:
+    """
+    Checks whether any point of the first set is closer than `distance` to any point of the second set.
+    """
+    offsets = points1.reshape(-1, 1, 2).astype(np.int64) - points2.reshape(1, -1, 2)
+    return bool(((offsets ** 2).sum(axis=-1) < distance ** 2).any())
+
+
+def _rects_within(contours: Sequence[Contour], distance: float) -> ndarray:
+    """
+    A matrix of which pairs of contours have bounding rectangles closer than `distance`.
+    Contours with farther bounding rectangles can't have close points, so this is a cheap filter.
+    """
+    x, y, width, height = np.array([contour.bounding_rect for contour in contours]).reshape(-1, 4).T
+    gap_x = np.maximum(0, np.maximum.outer(x, x) - np.minimum.outer(x + width - 1, x + width - 1))
+    gap_y = np.maximum(0, np.maximum.outer(y, y) - np.minimum.outer(y + height - 1, y + height - 1))
+    return gap_x ** 2 + gap_y ** 2 < distance ** 2
+
+
+def _find_root(parents: List[int], index: int) -> int:
+    while parents[index] != index:
+        parents[index] = parents[parents[index]]
+        index = parents[index]
+    return index
+
+
+def group_close_contours(contours: Sequence[Contour], closeness: int, jump: int = 10) -> List[List[int]]:
+    """
+    Groups the indices of contours that are connected by chains of close contours (see `Contour.is_close_to`).
+
+    Groups are ordered by their largest index, and the indices in each group are sorted.
+    """
+    parents = list(range(len(contours)))
+    points = [contour.points[::jump] for contour in contours]
+    for i, j in zip(*np.nonzero(np.triu(_rects_within(contours, closeness), 1))):
+        root_i, root_j = _find_root(parents, i), _find_root(parents, j)
+        if root_i != root_j and _points_close(points[i], points[j], closeness):
+            parents[max(root_i, root_j)] = min(root_i, root_j)
+    groups: Dict[int, List[int]] = {}
+    for index in range(len(contours)):
+        groups.setdefault(_find_root(parents, index), []).append(index)
+    return sorted(groups.values(), key=lambda group: group[-1])
+
+
+def group_contours_by_dilation(contours: Sequence[Contour], shape: Tuple[int, ...], closeness: int) -> List[List[int]]:
+    """
+    Groups the indices of contours whose filled shapes touch after being dilated by half the closeness,
+    i.e. contours which are (through chains) closer than `closeness` to each other.
+    This is a single pass over the image, instead of comparing pairs of contours.
+
+    Groups are ordered by their largest index, and the indices in each group are sorted.
+    """
+    mask = np.zeros(shape[:2], np.uint8)
+    cv.drawContours(mask, [contour.points for contour in contours], -1, MAX_PIXEL_VALUE, -1)
+    # Thresholding the distance from the contours is a dilation by a disk, in time independent of its size
+    distances = cv.distanceTransform(cv.bitwise_not(mask), cv.DIST_L2, cv.DIST_MASK_PRECISE)
+    labels = cv.connectedComponents((distances < closeness / 2).astype(np.uint8))[1]
+    groups: Dict[int, List[int]] = {}
+    for index, contour in enumerate(contours):
+        x, y = contour.points[0, 0]
+        groups.setdefault(labels[y, x], []).append(index)
+    return sorted(groups.values(), key=lambda group: group[-1])
+
+
+def join_close_contours(contours: Sequence[Contour], closeness: int, jump: int = 10) -> Sequence[Contour]:
+    return [join_contours([contours[index] for index in group])
+            for group in group_close_contours(contours, closeness, jump)]
 
 
-def find_contours(image: Image, external_only: bool = False) -> Sequence[Contour]:
+def find_contours(image: Image, external_only: bool = False, offset: Tuple[int, int] = (0, 0)) -> Sequence[Contour]:
+    """
+    Finds the contours in a binary image, with their points shifted by the (x, y) offset
+    (e.g. the position of the image in a larger image it was cropped from).
+    """
     mode = cv.RETR_EXTERNAL if external_only else cv.RETR_TREE
-    return tuple(map(Contour, cv.findContours(image, mode, cv.CHAIN_APPROX_SIMPLE)[0]))
+    return tuple(map(Contour, cv.findContours(image, mode, cv.CHAIN_APPROX_SIMPLE, offset=offset)[0]))
 
 
 def draw_contours(image: Image,
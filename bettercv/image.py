@@ -72,6 +72,22 @@ def avg(images: Iterable[Image], std: bool = False) -> Union[Image, Tuple[Image,
     return avg_image
 
 
+def accumulate_avg(avg: Image, image: Image, alpha: float) -> None:
+    """
+    Updates a running (exponential moving) average in place, giving the image a weight of `alpha`.
+    The average must be a float image, so repeated updates don't lose precision.
+    """
+    cv.accumulateWeighted(image, avg, alpha)
+
+
+def approach_median(median: Image, image: Image) -> None:
+    """
+    Updates a running approximate median in place, by moving each pixel one level towards the image.
+    """
+    cv.add(median, 1, dst=median, mask=cv.compare(image, median, cv.CMP_GT))
+    cv.subtract(median, 1, dst=median, mask=cv.compare(image, median, cv.CMP_LT))
+
+
 def min(images: Iterable[Image]) -> Image:
     return reduce(cv.min, images)
 
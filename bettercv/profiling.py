@@ -0,0 +1,205 @@
+import json
+import math
+import threading
+from pathlib import Path
+from time import perf_counter
+from collections import Counter
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import ContextManager, Dict, Generator, Iterable, Iterator, List, Optional, Tuple
+
+# The latency histograms have buckets up to 2^(i / BUCKETS_PER_OCTAVE) microseconds, for every integer i
+BUCKETS_PER_OCTAVE = 4
+
+
+@dataclass
+class StageStats:
+    """
+    The timing of a single stage.
+
+    calls (int): How many times the stage ran (e.g. once per frame)
+    seconds (float): The total time spent in the stage, excluding the nested stages
+    histogram (Counter): How many calls took up to each bucket's latency (see `BUCKETS_PER_OCTAVE`)
+    """
+    calls: int = 0
+    seconds: float = 0
+    histogram: Counter = field(default_factory=Counter)
+
+    def record(self, seconds: float) -> None:
+        self.calls += 1
+        self.seconds += seconds
+        self.histogram[math.ceil(BUCKETS_PER_OCTAVE * math.log2(max(seconds * 1e6, 1)))] += 1
+
+    def percentile(self, fraction: float) -> float:
+        """
+        An upper bound of the given percentile of the call latency (in seconds), from the histogram.
+        """
+        target, seen = fraction * self.calls, 0
+        for bucket in sorted(self.histogram):
+            seen += self.histogram[bucket]
+            if seen >= target:
+                return 2 ** (bucket / BUCKETS_PER_OCTAVE) / 1e6
+        return 0
+
+
+class _NullSpan:
+    def __enter__(self) -> None:
+        pass
+
+    def __exit__(self, *exc_info) -> None:
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class NullProfiler:
+    """
+    A profiler that records nothing, which is used while profiling is disabled (see `profiling`).
+    Its hooks do as little as possible, so they can stay in hot loops.
+    """
+
+    def span(self, name: str) -> _NullSpan:
+        return _NULL_SPAN
+
+    def iterate(self, name: str, iterable: Iterable) -> Iterable:
+        return iterable
+
+    def count(self, name: str, amount: int = 1) -> None:
+        pass
+
+
+class Profiler(NullProfiler):
+    """
+    Collects the time spent in each stage of a pipeline, and counts of things that pass through it.
+
+    The time of a stage excludes the time of stages nested in it,
+    so stages of lazy (generator) pipelines don't include the stages they pull their inputs from.
+
+    Example:
+        ```
+        with profiling(Profiler()) as profiler:
+            for frame in video:
+                with span("blur"):
+                    blurred = blur(frame)
+        print(profiler.summary())
+        ```
+    """
+
+    def __init__(self, trace: bool = False) -> None:
+        """
+        Args:
+            trace: Whether to keep every span, to export them (see `save_trace`)
+        """
+        self.stages: Dict[str, StageStats] = {}
+        self.counters: Counter = Counter()
+        self.events: Optional[List[Tuple[str, int, float, float]]] = [] if trace else None
+        self._local = threading.local()
+        self._start = perf_counter()
+        self._stop = None
+
+    def _stack(self) -> List[float]:
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    @contextmanager
+    def span(self, name: str) -> Generator[None, None, None]:
+        """
+        Times the code in the context as a call of the given stage.
+        """
+        stack = self._stack()
+        # The time spent in nested spans, which is excluded from this span
+        stack.append(0)
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = perf_counter() - start
+            nested = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            self.stages.setdefault(name, StageStats()).record(elapsed - nested)
+            if self.events is not None:
+                self.events.append((name, threading.get_ident(), start, elapsed))
+
+    def iterate(self, name: str, iterable: Iterable) -> Iterator:
+        """
+        Times each step of an iterable (e.g. a generator stage) as a call of the given stage.
+        The time the consumer spends between the steps is not included.
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.span(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def count(self, name: str, amount: int = 1) -> None:
+        self.counters[name] += amount
+
+    def stop(self) -> None:
+        self._stop = perf_counter()
+
+    @property
+    def wall_seconds(self) -> float:
+        return (self._stop or perf_counter()) - self._start
+
+    def summary(self) -> str:
+        """
+        Returns:
+            A table of the stages (slowest first) and the counters
+        """
+        wall = self.wall_seconds
+        lines = [f"{'stage':<20}{'calls':>10}{'seconds':>10}{'%':>7}{'mean ms':>10}{'p50 ms':>10}{'p99 ms':>10}"]
+        for name, stats in sorted(self.stages.items(), key=lambda item: -item[1].seconds):
+            lines.append(f"{name:<20}{stats.calls:>10}{stats.seconds:>10.3f}{100 * stats.seconds / wall:>7.1f}"
+                         f"{1000 * stats.seconds / stats.calls:>10.3f}"
+                         f"{1000 * stats.percentile(0.5):>10.3f}{1000 * stats.percentile(0.99):>10.3f}")
+        other = wall - sum(stats.seconds for stats in self.stages.values())
+        lines.append(f"{'(other)':<20}{'':>10}{other:>10.3f}{100 * other / wall:>7.1f}")
+        lines.append(f"{'(wall)':<20}{'':>10}{wall:>10.3f}")
+        lines.extend(f"{name}: {count}" for name, count in self.counters.items())
+        return "\n".join(lines)
+
+    def save_trace(self, path: Path) -> None:
+        """
+        Saves the spans in the Chrome trace format, which can be opened in `chrome://tracing` or Perfetto.
+        The profiler must have been created with `trace=True`.
+        """
+        events = [{"name": name, "ph": "X", "pid": 0, "tid": thread,
+                   "ts": (start - self._start) * 1e6, "dur": elapsed * 1e6}
+                  for name, thread, start, elapsed in self.events or []]
+        path.write_text(json.dumps({"traceEvents": events, "otherData": dict(self.counters)}))
+
+
+_profiler: NullProfiler = NullProfiler()
+
+
+@contextmanager
+def profiling(profiler: Profiler = None) -> Generator[Profiler, None, None]:
+    """
+    Enables the profiling hooks (`span`, `iterate` and `count`) in the context, recording into the given profiler.
+    """
+    global _profiler
+    profiler = profiler or Profiler()
+    previous, _profiler = _profiler, profiler
+    try:
+        yield profiler
+    finally:
+        _profiler = previous
+        profiler.stop()
+
+
+def span(name: str) -> ContextManager[None]:
+    return _profiler.span(name)
+
+
+def iterate(name: str, iterable: Iterable) -> Iterable:
+    return _profiler.iterate(name, iterable)
+
+
+def count(name: str, amount: int = 1) -> None:
+    _profiler.count(name, amount)
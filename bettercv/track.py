@@ -1,6 +1,9 @@
+import numpy as np
+from array import array
 from datetime import timedelta
-from dataclasses import dataclass
-from typing import List, Iterator, Union
+from operator import attrgetter
+from dataclasses import dataclass, field, replace
+from typing import List, Iterator, Union, Dict, Callable, Optional, Any
 
 from .video import Frame, Ref
 from .contours import Contour
@@ -11,6 +14,8 @@ class Snapshot:
     ref: Ref
     index: int
     contour: Contour
+    # Pixel-based measurements of the contour, taken while its frame was available
+    features: Dict[str, float] = field(default_factory=dict)
 
     def __repr__(self) -> str:
         return f"<Snapshot at {self.ref.index}, {self.ref.time} from {self.ref.video}>"
@@ -20,8 +25,46 @@ class Snapshot:
 
 
 class Track:
-    def __init__(self):
-        self.snapshots: List[Snapshot] = []
+    """
+    A contour tracked over consecutive frames.
+
+    Only a summary of the track is kept by default: its first, last and best snapshots (by the given key),
+    and the indices, timestamps and centroids of all its frames (in compact arrays).
+    This keeps long tracks small, since each snapshot holds a full contour.
+    Every snapshot can still be kept with `keep_history` (e.g. for debugging).
+
+    Example:
+        ```
+        track = Track(key=lambda snapshot: snapshot.contour.area)
+        for frame, contour in zip(frames, contours):
+            track.record(contour, frame)
+        print(track.start.ref, track.end.ref, track.best.contour.area)
+        ```
+    """
+    __slots__ = ("key", "keep_history", "best", "_first", "_last", "_best_score", "_length",
+                 "_indices", "_timestamps", "_centroids", "_history")
+
+    def __init__(self, key: Callable[[Snapshot], float] = None, keep_history: bool = False) -> None:
+        """
+        Args:
+            key: The score of a snapshot, by which the best snapshot is chosen (if not given, there is no best snapshot)
+            keep_history: Whether to keep every snapshot, instead of only the first, last and best ones
+        """
+        self.key = key
+        self.keep_history = keep_history
+        self.best: Optional[Snapshot] = None
+        self._first: Optional[Snapshot] = None
+        self._last: Optional[Snapshot] = None
+        self._best_score = None
+        self._length = 0
+        self._indices = array("q")
+        self._timestamps = array("d")
+        # The x and y of each centroid, interleaved
+        self._centroids = array("d")
+        self._history: Optional[List[Snapshot]] = [] if keep_history else None
+
+    def __len__(self) -> int:
+        return self._length
 
     def __iter__(self) -> Iterator[Snapshot]:
         return iter(self.snapshots)
@@ -29,13 +72,36 @@ class Track:
     def __getitem__(self, index: Union[int, slice]) -> Snapshot:
         return self.snapshots[index]
 
+    def __getstate__(self) -> Dict[str, Any]:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        if "snapshots" in state:
+            # A track pickled before tracks were compact (e.g. in an old checkpoint), which has every snapshot
+            self.__init__(keep_history=True)
+            for snapshot in state["snapshots"]:
+                self._append(snapshot)
+            return
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    @property
+    def snapshots(self) -> List[Snapshot]:
+        """
+        Every snapshot if the history is kept, otherwise only the first, best and last ones (in order).
+        """
+        if self._history is not None:
+            return self._history
+        return sorted({id(snapshot): snapshot for snapshot in (self._first, self.best, self._last)
+                       if snapshot is not None}.values(), key=attrgetter("index"))
+
     @property
     def start(self) -> Snapshot:
-        return self[0]
+        return self._first
 
     @property
     def end(self) -> Snapshot:
-        return self[-1]
+        return self._last
 
     @property
     def extent(self) -> int:
@@ -45,5 +111,59 @@ class Track:
     def duration(self) -> timedelta:
         return self.end.ref.time - self.start.ref.time
 
-    def record(self, contour: Contour, frame: Frame) -> None:
-        self.snapshots.append(Snapshot(frame.ref, len(self.snapshots), contour))
+    @property
+    def indices(self) -> np.ndarray:
+        return np.frombuffer(self._indices, dtype=np.int64)
+
+    @property
+    def timestamps(self) -> np.ndarray:
+        return np.frombuffer(self._timestamps, dtype=np.float64)
+
+    @property
+    def centroids(self) -> np.ndarray:
+        """
+        The centroids of the contours in all the frames of the track, as an array of (x, y) rows.
+        """
+        return np.frombuffer(self._centroids, dtype=np.float64).reshape(-1, 2)
+
+    def _append(self, snapshot: Snapshot, score: float = None) -> None:
+        if self._first is None:
+            self._first = snapshot
+        self._last = snapshot
+        if self.key:
+            score = self.key(snapshot) if score is None else score
+            # Like max(), the first of equally good snapshots is the best
+            if self.best is None or score > self._best_score:
+                self.best, self._best_score = snapshot, score
+        self._indices.append(snapshot.ref.index)
+        self._timestamps.append(snapshot.ref.timestamp)
+        self._centroids.extend(snapshot.contour.centroid)
+        if self._history is not None:
+            self._history.append(snapshot)
+        self._length += 1
+
+    def record(self, contour: Contour, frame: Frame, features: Dict[str, float] = None) -> None:
+        self._append(Snapshot(frame.ref, self._length, contour, features or {}))
+
+    def extend(self, other: "Track") -> None:
+        """
+        Continues the track with the snapshots of another track (which starts right after it ends).
+        """
+        offset = self._length
+        if other._history is not None and self._history is not None:
+            for snapshot in other._history:
+                self._history.append(replace(snapshot, index=offset + snapshot.index))
+        elif self._history is not None:
+            # The other track's snapshots between its kept ones are gone, so this history is incomplete now
+            self._history = None
+        moved = {id(snapshot): replace(snapshot, index=offset + snapshot.index)
+                 for snapshot in (other._first, other.best, other._last) if snapshot is not None}
+        self._last = moved[id(other._last)]
+        if self.key and other.best is not None:
+            score = other._best_score if other.key is self.key else self.key(other.best)
+            if self.best is None or score > self._best_score:
+                self.best, self._best_score = moved[id(other.best)], score
+        self._indices.extend(other._indices)
+        self._timestamps.extend(other._timestamps)
+        self._centroids.extend(other._centroids)
+        self._length += other._length
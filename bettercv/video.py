@@ -1,9 +1,14 @@
+import json
 import cv2 as cv
+import numpy as np
 from pathlib import Path
+from bisect import bisect_right
 from datetime import timedelta
-from dataclasses import dataclass
-from typing import Generator, Union, List
+from collections import OrderedDict
+from dataclasses import dataclass, asdict
+from typing import Generator, Union, List, Iterable, Optional
 
+from . import profiling
 from .types import Image
 
 
@@ -60,6 +65,113 @@ class Frame:
         return f"<Frame {self.ref.index}, {self.ref.time} from {self.ref.video.name}>"
 
 
+# The suffix of the sidecar file a video's index is saved in (see `VideoIndex`)
+INDEX_SUFFIX = ".index.json"
+# How many of the recently read random-access frames are kept in memory
+FRAME_CACHE_SIZE = 32
+# Without a keyframe index, random reads decode forward instead of seeking if the target is at most this far ahead
+MAX_FORWARD_GAP = 30
+
+
+@dataclass
+class FrameBatch:
+    """
+    Consecutive frames (or frames at a fixed jump) of a video, stacked into a single array.
+
+    Attributes:
+        images (ndarray): The images, as an array of shape (n, height, width[, channels])
+        indices (ndarray): The indices of the frames in the video
+        timestamps (ndarray): The timestamps of the frames, in seconds (computed from the frame rate)
+        video (Path): The path to the video file
+    """
+    images: np.ndarray
+    indices: np.ndarray
+    timestamps: np.ndarray
+    video: Path
+
+    def __len__(self) -> int:
+        return len(self.indices)
+
+    def __iter__(self) -> Generator[Frame, None, None]:
+        """
+        Yields the frames of the batch, whose images are views into the batch's array.
+        """
+        for image, index, timestamp in zip(self.images, self.indices.tolist(), self.timestamps.tolist()):
+            yield Frame(image, Ref(self.video, index, timestamp))
+
+
+@dataclass
+class VideoIndex:
+    """
+    The metadata of a video file, saved in a sidecar file next to it, so it isn't queried again on every open.
+
+    size (int): The size of the video file in bytes, to detect changes to the file
+    modified (int): The modification time of the video file in nanoseconds, to detect changes to the file
+    frame_num (int): The number of frames in the video
+    width (int): The width of the frames, in pixels
+    height (int): The height of the frames, in pixels
+    fps (int): The frame rate of the video, rounded down (see `Video.fps`)
+    frame_rate (float): The exact frame rate of the video
+    keyframes (List[int]): The indices of the keyframes in ascending order
+                           (None until the first random read, empty if the keyframes can't be found)
+    """
+    size: int
+    modified: int
+    frame_num: int
+    width: int
+    height: int
+    fps: int
+    frame_rate: float
+    keyframes: Optional[List[int]] = None
+
+
+def _index_path(path: Path) -> Path:
+    return path.with_name(path.name + INDEX_SUFFIX)
+
+
+def _load_index(path: Path) -> Optional[VideoIndex]:
+    """
+    Returns:
+        The saved index of the video, or None if there is none or if the video changed since it was saved
+    """
+    try:
+        index = VideoIndex(**json.loads(_index_path(path).read_text()))
+    except (OSError, ValueError, TypeError):
+        return None
+    stat = path.stat()
+    return index if (index.size, index.modified) == (stat.st_size, stat.st_mtime_ns) else None
+
+
+def _save_index(path: Path, index: VideoIndex) -> None:
+    try:
+        _index_path(path).write_text(json.dumps(asdict(index)))
+    except OSError:
+        # The video may be in a read-only directory, in which case the index is just not persisted
+        pass
+
+
+def _find_keyframes(path: Path) -> List[int]:
+    """
+    Finds the keyframes by reading the raw packets of the video, without decoding them.
+
+    Returns:
+        The indices of the keyframes, or an empty list if the backend can't read raw packets
+    """
+    cap = cv.VideoCapture(str(path))
+    try:
+        if not cap.set(cv.CAP_PROP_FORMAT, -1):
+            return []
+        keyframes = []
+        index = 0
+        while cap.grab():
+            if cap.get(cv.CAP_PROP_LRF_HAS_KEY_FRAME):
+                keyframes.append(index)
+            index += 1
+        return keyframes
+    finally:
+        cap.release()
+
+
 class Video:
     """
     A video that is read from a file.
@@ -75,16 +187,28 @@ class Video:
                 # Do some image analysis
         ```
 
+    Random access (indexing) uses a separate video capture, so it doesn't disturb iteration.
+    It decodes forward from the nearest keyframe (or from the previous random read, if there is no keyframe between
+    them), and keeps the recently read frames in memory, so repeated and near-sequential random reads are cheap.
+    The keyframes and the metadata of the video are saved in a sidecar file next to it (see `VideoIndex`).
+
     Args:
         path (str or Path): The path to the video file
+        cache_size (int): How many of the recently read random-access frames to keep in memory
 
     Attributes:
         path (Path): The path to the video file
     """
 
-    def __init__(self, path: Union[Path, str]) -> None:
+    def __init__(self, path: Union[Path, str], cache_size: int = FRAME_CACHE_SIZE) -> None:
         self.path = Path(path)
+        self.cache_size = cache_size
         self._cap = None
+        self._index = None
+        self._random_cap = None
+        # The index of the frame the random-access capture reads next
+        self._random_position = None
+        self._cache: OrderedDict[int, Frame] = OrderedDict()
 
     def __enter__(self) -> "Video":
         return self.open()
@@ -99,11 +223,9 @@ class Video:
     def __iter__(self) -> Generator[Frame, None, None]:
         return self.iter_frames()
 
-    def __getitem__(self, index: Union[int, slice]) -> Union[Frame, List[Frame]]:
+    def __getitem__(self, index: Union[int, slice]) -> Union[Frame, "VideoView"]:
         if isinstance(index, slice):
-            return list(self.iter_frames(start=index.start or 0,
-                                         stop=index.stop,
-                                         jump=index.step if index.step is not None else 1))
+            return VideoView(self, index.start or 0, index.stop, index.step if index.step is not None else 1)
         return self.read_frame_at(index)
 
     def __str__(self):
@@ -195,6 +317,7 @@ class Video:
             self._cap = cv.VideoCapture(str(self.path))
             if not self._cap.isOpened():
                 raise OSError(f"Could not open video file at {self.path}")
+            self._index = _load_index(self.path) or self._read_index()
         return self
 
     def close(self) -> None:
@@ -204,6 +327,26 @@ class Video:
         if self._is_open():
             self._cap.release()
             self._cap = None
+        if self._random_cap:
+            self._random_cap.release()
+            self._random_cap = None
+            self._random_position = None
+        self._cache.clear()
+
+    def _read_index(self) -> VideoIndex:
+        """
+        Reads the metadata of the video from the capture, and saves it.
+        """
+        stat = self.path.stat()
+        index = VideoIndex(size=stat.st_size,
+                           modified=stat.st_mtime_ns,
+                           frame_num=self._get_prop(cv.CAP_PROP_FRAME_COUNT),
+                           width=self._get_prop(cv.CAP_PROP_FRAME_WIDTH),
+                           height=self._get_prop(cv.CAP_PROP_FRAME_HEIGHT),
+                           fps=self._get_prop(cv.CAP_PROP_FPS),
+                           frame_rate=self._cap.get(cv.CAP_PROP_FPS))
+        _save_index(self.path, index)
+        return index
 
     @property
     def name(self) -> str:
@@ -217,28 +360,44 @@ class Video:
         """
         The number of frames in the video
         """
-        return self._get_prop(cv.CAP_PROP_FRAME_COUNT)
+        self._raise_if_closed()
+        return self._index.frame_num
 
     @property
     def width(self) -> int:
         """
         The width of the frames in the video, in pixels
         """
-        return self._get_prop(cv.CAP_PROP_FRAME_WIDTH)
+        self._raise_if_closed()
+        return self._index.width
 
     @property
     def height(self) -> int:
         """
         The height of the frames in the video, in pixels
         """
-        return self._get_prop(cv.CAP_PROP_FRAME_HEIGHT)
+        self._raise_if_closed()
+        return self._index.height
 
     @property
     def fps(self) -> int:
         """
         The frame rate of the video, in frames per second
         """
-        return self._get_prop(cv.CAP_PROP_FPS)
+        self._raise_if_closed()
+        return self._index.fps
+
+    @property
+    def keyframes(self) -> List[int]:
+        """
+        The indices of the keyframes in the video (empty if they can't be found).
+        They are found on first use, and saved with the rest of the video's metadata.
+        """
+        self._raise_if_closed()
+        if self._index.keyframes is None:
+            self._index.keyframes = _find_keyframes(self.path)
+            _save_index(self.path, self._index)
+        return self._index.keyframes
 
     @property
     def duration(self) -> timedelta:
@@ -282,7 +441,7 @@ class Video:
             index: The index of the frame to read
 
         Returns:
-            The read frame
+            The read frame (a copy of it, if it was cached)
 
         Raises:
             OSError: if the video is not open for reading, or if the frame could not be read
@@ -291,11 +450,62 @@ class Video:
         self._raise_if_closed()
         if index < 0 or index >= self.frame_num:
             raise IndexError("No frame available at the given index! Check the length of the video.")
-        original_index = self._next_frame_index()
-        self._jump_to_frame(index)
-        frame = self._read_next()
-        self._jump_to_frame(original_index)
-        return frame
+        if index in self._cache:
+            self._cache.move_to_end(index)
+        else:
+            self._decode_at(index)
+        frame = self._cache[index]
+        # The cached frame is copied, so callers may draw on it
+        return frame.with_image(frame.image.copy())
+
+    def _can_decode_forward(self, index: int) -> bool:
+        """
+        Returns:
+            Whether to read the given index by decoding forward from the random-access capture's position,
+            which is cheaper than seeking if the index is close or if there is no keyframe between them
+        """
+        position = self._random_position
+        if position is None or position > index:
+            return False
+        return index - position <= MAX_FORWARD_GAP or self._keyframe_before(index) <= position
+
+    def _keyframe_before(self, index: int) -> int:
+        """
+        Returns:
+            The index of the last keyframe up to the given index (or the index itself if the keyframes are unknown)
+        """
+        keyframes = self.keyframes
+        position = bisect_right(keyframes, index)
+        return keyframes[position - 1] if position else index
+
+    def _cache_frame(self, frame: Frame) -> None:
+        self._cache[frame.ref.index] = frame
+        self._cache.move_to_end(frame.ref.index)
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def _decode_at(self, index: int) -> None:
+        """
+        Reads a frame into the cache with the random-access capture, decoding forward from its position
+        or from the nearest keyframe.
+        The last few frames decoded on the way are cached as well, since stepping back to them is common.
+        """
+        if self._random_cap is None:
+            self._random_cap = cv.VideoCapture(str(self.path))
+        if not self._can_decode_forward(index):
+            self._random_position = self._keyframe_before(index)
+            self._random_cap.set(cv.CAP_PROP_POS_FRAMES, self._random_position)
+        with profiling.span("decode"):
+            for position in range(self._random_position, index + 1):
+                if index - position > self.cache_size // 4:
+                    self._random_cap.grab()
+                    continue
+                success, image = self._random_cap.read()
+                if not success:
+                    raise OSError(f"Could not read frame at index {position}")
+                timestamp = int(self._random_cap.get(cv.CAP_PROP_POS_MSEC)) / 1000
+                self._cache_frame(Frame(image, Ref(self.path, position, timestamp)))
+        self._random_position = index + 1
 
     def iter_frames(self, *,
                     start: int = 0,
@@ -332,9 +542,146 @@ class Video:
         self._jump_to_frame(start or 0)
         stop = self.frame_num if stop is None else min(stop, self.frame_num)
         while self._next_frame_index() < stop:
-            frame = self._read_next()
+            with profiling.span("decode"):
+                frame = self._read_next()
             yield frame
             # This condition is an optimization to avoid the additional IO operation when jump = 1,
             # which is redundant since `self._read_next` automatically advances the capture pointer.
             if jump > 1:
                 self._jump_to_frame(frame.ref.index + jump)
+
+    def iter_batches(self, n: int, *,
+                     start: int = 0,
+                     stop: int = None,
+                     jump: int = 1,
+                     reuse: bool = False) -> Generator[FrameBatch, None, None]:
+        """
+        Yields batches of frames from a specified slice of the video, each stacked into a single array.
+        The frames are decoded straight into the array, and their indices and timestamps are computed from the slice
+        and the frame rate, so there is no per-frame overhead besides decoding.
+
+        Args:
+            n: The number of frames in each batch (the last batch may be shorter)
+            start: The index of the first frame to read
+            stop: The index of the last frame to read
+            jump: How many indices to jump between frame reads. Must be positive.
+            reuse: Whether to decode all the batches into the same array, which saves allocating an array
+                   for each batch, but overwrites the previous batch (so it must be consumed before the next one)
+
+        Returns:
+            A generator of frame batches
+
+        Raises:
+            OSError: if the video is not open for reading
+            ValueError: if the jump is not positive
+        """
+        if jump <= 0:
+            raise ValueError("Jump must be positive!")
+        self._raise_if_closed()
+        stop = self.frame_num if stop is None else min(stop, self.frame_num)
+        indices = np.arange(start, stop, jump)
+        buffer = None
+        self._jump_to_frame(start)
+        for batch_start in range(0, len(indices), n):
+            batch_indices = indices[batch_start:batch_start + n]
+            if buffer is None or not reuse:
+                buffer = np.empty((n, self.height, self.width, 3), np.uint8)
+            with profiling.span("decode"):
+                for position, index in enumerate(batch_indices.tolist()):
+                    if position or batch_start:
+                        self._skip_to(index, index - jump + 1)
+                    if not self._cap.read(buffer[position])[0]:
+                        # The frame count is only an estimate for some formats
+                        batch_indices = batch_indices[:position]
+                        break
+            if len(batch_indices):
+                yield FrameBatch(buffer[:len(batch_indices)], batch_indices,
+                                 batch_indices / self._index.frame_rate, self.path)
+            if len(batch_indices) < min(n, len(indices) - batch_start):
+                return
+
+    def _skip_to(self, index: int, position: int) -> None:
+        """
+        Moves the video capture pointer from a known position to a later index,
+        by grabbing the frames in between if they are few, or by seeking.
+        """
+        if index - position > MAX_FORWARD_GAP:
+            self._jump_to_frame(index)
+            return
+        for _ in range(index - position):
+            self._cap.grab()
+
+    def iter_frames_at(self, indices: Iterable[int], max_gap: int = 30) -> Generator[Frame, None, None]:
+        """
+        Yields the frames at the given indices, which should be sorted in ascending order.
+
+        Small gaps between consecutive indices are skipped by grabbing (without decoding) the frames in between,
+        which is much cheaper than seeking, since seeking decodes from the previous keyframe.
+
+        Args:
+            indices: The indices of the frames to read, in ascending order
+            max_gap: The largest gap to skip without seeking
+
+        Returns:
+            A generator of frames
+
+        Raises:
+            OSError: if the video is not open for reading, or if a frame could not be read
+        """
+        self._raise_if_closed()
+        position = None
+        for index in indices:
+            if position is None or not 0 <= index - position <= max_gap:
+                self._jump_to_frame(index)
+            else:
+                for _ in range(index - position):
+                    self._cap.grab()
+            with profiling.span("decode"):
+                frame = self._read_next()
+            position = index + 1
+            yield frame
+
+
+class VideoView:
+    """
+    A lazy slice of a video (returned by slicing a `Video`), which reads its frames only when they are needed.
+    Acts as a sequence of `Frame`s, like the video itself.
+
+    Example:
+        ```
+        with Video("/path/to/video.mp4") as video:
+            view = video[100:1000:2]
+            print(len(view), view[0].ref.index)  # prints 450 100
+            for batch in view.iter_batches(64):
+                # Do some vectorized image analysis on batch.images
+        ```
+
+    Attributes:
+        video (Video): The sliced video
+        start (int): The index of the first frame in the view
+        stop (int): The index after the last frame in the view
+        jump (int): The jump between the indices of consecutive frames in the view
+    """
+
+    def __init__(self, video: Video, start: int = 0, stop: int = None, jump: int = 1) -> None:
+        self.video = video
+        self._range = range(video.frame_num)[start:stop:jump]
+        self.start, self.stop, self.jump = self._range.start, self._range.stop, self._range.step
+
+    def __len__(self) -> int:
+        return len(self._range)
+
+    def __iter__(self) -> Generator[Frame, None, None]:
+        return self.video.iter_frames(start=self.start, stop=self.stop, jump=self.jump)
+
+    def __getitem__(self, index: Union[int, slice]) -> Union[Frame, "VideoView"]:
+        if isinstance(index, slice):
+            sliced = self._range[index]
+            return VideoView(self.video, sliced.start, sliced.stop, sliced.step)
+        return self.video.read_frame_at(self._range[index])
+
+    def __repr__(self) -> str:
+        return f"<VideoView {self.video.name}[{self.start}:{self.stop}:{self.jump}]>"
+
+    def iter_batches(self, n: int, reuse: bool = False) -> Generator[FrameBatch, None, None]:
+        return self.video.iter_batches(n, start=self.start, stop=self.stop, jump=self.jump, reuse=reuse)
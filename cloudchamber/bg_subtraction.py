@@ -1,6 +1,9 @@
+import cv2 as cv
+import numpy as np
 from itertools import tee
 from more_itertools import chunked
-from typing import Iterable, Generator
+from dataclasses import dataclass
+from typing import Iterable, Generator, Optional
 
 import bettercv.image as img
 from bettercv.video import Frame
@@ -9,6 +12,25 @@ from bettercv.display import Window
 from .config import Config
 
 
+# The BG methods whose state depends on every frame since the start (see `BGState`)
+STATEFUL_METHODS = ("ema", "median", "replace")
+
+
+@dataclass
+class BGState:
+    """
+    The state of the "ema", "median" and "replace" BG methods, which depends on every frame since the start.
+    It is updated as the frames are subtracted, so it can be saved (e.g. in a checkpoint) and continued from exactly.
+
+    bg (ndarray): The BG (None before the first frame)
+    count (int): The number of frames subtracted so far ("ema" and "median" update their BG every `bg_jump`-th frame)
+    had_tracks (bool): Whether the last frame had tracks ("replace" only)
+    """
+    bg: Optional[np.ndarray] = None
+    count: int = 0
+    had_tracks: bool = False
+
+
 def has_tracks(threshold: float, min_thresh: float) -> bool:
     return threshold >= min_thresh
 
@@ -31,20 +53,56 @@ def subtract_bg_avg(frames: Iterable[Frame], config: Config) -> Generator[Frame,
             yield frame.with_image(img.subtract(frame.image, bg))
 
 
-def subtract_bg_replace(frames: Iterable[Frame], config: Config) -> Generator[Frame, None, None]:
-    had_tracks = False
-    bg = next(iter(frames)).image
+def subtract_bg_ema(frames: Iterable[Frame], config: Config, state: BGState = None) -> Generator[Frame, None, None]:
+    """
+    Subtracts a running average BG, which every `bg_jump`-th frame updates (after it was subtracted from).
+    Unlike "avg", it takes the memory of a single frame and has no seams between batches.
+    The BG is updated before the frame is yielded, so the state always includes the yielded frames.
+    """
+    state = state or BGState()
+    for frame in frames:
+        if state.bg is None:
+            state.bg = frame.image.astype(np.float32)
+        difference = img.subtract(frame.image, cv.convertScaleAbs(state.bg))
+        if state.count % config.bg_jump == 0:
+            img.accumulate_avg(state.bg, frame.image, config.bg_alpha)
+        state.count += 1
+        yield frame.with_image(difference)
+
+
+def subtract_bg_median(frames: Iterable[Frame], config: Config,
+                       state: BGState = None) -> Generator[Frame, None, None]:
+    """
+    Like `subtract_bg_ema`, but with a running approximate median BG, which tracks hardly affect.
+    """
+    state = state or BGState()
+    for frame in frames:
+        if state.bg is None:
+            state.bg = frame.image.copy()
+        difference = img.subtract(frame.image, state.bg)
+        if state.count % config.bg_jump == 0:
+            img.approach_median(state.bg, frame.image)
+        state.count += 1
+        yield frame.with_image(difference)
+
+
+def subtract_bg_replace(frames: Iterable[Frame], config: Config,
+                        state: BGState = None) -> Generator[Frame, None, None]:
+    state = state or BGState()
+    frames = iter(frames)
+    if state.bg is None:
+        state.bg = next(frames).image
     for frame in frames:
-        thresh, binary = img.threshold_otsu(img.subtract(frame.image, bg))
+        thresh, binary = img.threshold_otsu(img.subtract(frame.image, state.bg))
         if has_tracks(thresh, config.min_threshold):
-            had_tracks = True
+            state.had_tracks = True
             yield frame.with_image(binary)
         else:
-            if had_tracks:
+            if state.had_tracks:
                 if config.prints:
                     print(f"New BG is {frame}")
-                bg = frame.image
-            had_tracks = False
+                state.bg = frame.image
+            state.had_tracks = False
 
 
 def subtract_bg_mog2(frames: Iterable[Frame]) -> Generator[Frame, None, None]:
@@ -53,11 +111,18 @@ def subtract_bg_mog2(frames: Iterable[Frame]) -> Generator[Frame, None, None]:
     return (frame.with_image(fg) for frame, fg in zip(frames, fg_masks))
 
 
-def subtract_bg(frames: Iterable[Frame], config: Config) -> Generator[Frame, None, None]:
+def subtract_bg(frames: Iterable[Frame], config: Config, state: BGState = None) -> Generator[Frame, None, None]:
+    """
+    Yields the binary frames with tracks. The state of the BG methods which have one can be given to continue from.
+    """
     match config.bg_method:
         case "mog2":
             return subtract_bg_mog2(frames)
         case "avg":
             return binaries_with_tracks(subtract_bg_avg(frames, config), config)
+        case "ema":
+            return binaries_with_tracks(subtract_bg_ema(frames, config, state), config)
+        case "median":
+            return binaries_with_tracks(subtract_bg_median(frames, config, state), config)
         case "replace":
-            return subtract_bg_replace(frames, config)
+            return subtract_bg_replace(frames, config, state)
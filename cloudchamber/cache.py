@@ -0,0 +1,139 @@
+import os
+import shutil
+import numpy as np
+from hashlib import sha1
+from pathlib import Path
+from typing import Callable, Generator, Iterable, Iterator, List, Optional, Sequence, Tuple, TypeVar
+
+from bettercv.video import Ref
+from bettercv.contours import Contour
+
+from .config import Config, CONTOUR_FIELDS
+
+DEFAULT_MAX_SIZE = 4 * 1024 ** 3
+CHUNK_FRAMES = 1000  # The number of frames in each file of an entry
+
+# The reference to a frame, the shape of its image, and its prominent contours
+CachedFrame = Tuple[Ref, Tuple[int, ...], Sequence[Contour]]
+T = TypeVar("T")
+
+
+def _read_chunk(path: Path) -> List[CachedFrame]:
+    with np.load(path) as data:
+        video, shape = Path(str(data["video"])), tuple(data["shape"].tolist())
+        points, offsets = data["points"].reshape(-1, 1, 2), data["offsets"]
+        contours = [Contour(points[offsets[i]:offsets[i + 1]]) for i in range(len(offsets) - 1)]
+        bounds = np.cumsum([0, *data["counts"]])
+        refs = [Ref(video, index, timestamp)
+                for index, timestamp in zip(data["indices"].tolist(), data["timestamps"].tolist())]
+        return [(ref, shape, tuple(contours[bounds[i]:bounds[i + 1]])) for i, ref in enumerate(refs)]
+
+
+def _write_chunk(frames: Sequence[CachedFrame], path: Path) -> None:
+    contours = [contour.points.reshape(-1, 2) for _, _, frame_contours in frames for contour in frame_contours]
+    temp_path = path.with_name(f".{path.name}.tmp")
+    with open(temp_path, "wb") as file:
+        np.savez(file,
+                 video=str(frames[0][0].video),
+                 shape=np.array(frames[0][1], dtype=np.int64),
+                 indices=np.array([ref.index for ref, _, _ in frames], dtype=np.int64),
+                 timestamps=np.array([ref.timestamp for ref, _, _ in frames], dtype=np.float64),
+                 counts=np.array([len(frame_contours) for _, _, frame_contours in frames], dtype=np.int64),
+                 offsets=np.cumsum([0] + [len(points) for points in contours], dtype=np.int64),
+                 points=np.concatenate(contours).astype(np.int32) if contours else np.empty((0, 2), np.int32))
+    os.replace(temp_path, path)
+
+
+class ContourCache:
+    """
+    An on-disk cache of the prominent contours found in each frame of a video.
+
+    Entries are keyed by the video, the frame range and the upstream config fields, so runs which only change
+    the joining, tracking or filtering parameters can replay the contours instead of decoding the video.
+    Each entry is a directory of chunks of `CHUNK_FRAMES` frames, written and read one at a time,
+    so neither recording nor replaying a long video keeps all of its contours in memory.
+    An entry is only replayed once its recording is complete, but the chunks of an interrupted recording are kept,
+    so it can be continued.
+    The least recently used entries are evicted when the cache grows beyond its maximal size (in bytes).
+    """
+
+    def __init__(self, directory: Path, max_size: int = DEFAULT_MAX_SIZE) -> None:
+        self.directory = directory
+        self.max_size = max_size
+
+    def key(self, video: Path, start: int, stop: Optional[int], config: Config) -> str:
+        return sha1(f"{Path(video).resolve()}:{start}:{stop}:{config.digest(CONTOUR_FIELDS)}".encode()).hexdigest()
+
+    def _path(self, key: str, complete: bool = True) -> Path:
+        return self.directory / (key if complete else f"{key}.partial")
+
+    @staticmethod
+    def _chunks(path: Path) -> List[Path]:
+        return sorted(path.glob("*.npz"))
+
+    def load(self, key: str, complete: bool = True) -> Optional[Iterator[CachedFrame]]:
+        """
+        Lazily reads the frames of an entry, or of its interrupted recording if not `complete`.
+
+        Returns:
+            A generator of the cached frames, or None if there is no such entry
+        """
+        path = self._path(key, complete)
+        if not path.is_dir():
+            return None
+        # The modification time marks the last use, for eviction
+        os.utime(path)
+        return (frame for chunk in self._chunks(path) for frame in _read_chunk(chunk))
+
+    def recorded_until(self, key: str) -> Optional[int]:
+        """
+        The index of the last frame saved by an interrupted recording of the entry, if there is one.
+        """
+        chunks = self._chunks(self._path(key, complete=False))
+        if not chunks:
+            return None
+        with np.load(chunks[-1]) as data:
+            return int(data["indices"][-1])
+
+    def discard(self, key: str) -> None:
+        """
+        Removes an interrupted recording of the entry, if there is one.
+        """
+        shutil.rmtree(self._path(key, complete=False), ignore_errors=True)
+
+    def record(self, key: str, items: Iterable[T], to_frame: Callable[[T], CachedFrame]) -> Generator[T, None, None]:
+        """
+        Passes the items through while saving their frames to the entry in chunks,
+        after those of an interrupted recording.
+        The entry is complete once all the items were consumed. If the recording stops early (e.g. on an error),
+        the frames consumed so far are saved for it to be continued.
+        """
+        path = self._path(key, complete=False)
+        path.mkdir(parents=True, exist_ok=True)
+        number = len(self._chunks(path))
+        chunk = []
+        try:
+            for item in items:
+                chunk.append(to_frame(item))
+                if len(chunk) == CHUNK_FRAMES:
+                    _write_chunk(chunk, path / f"{number:06}.npz")
+                    number, chunk = number + 1, []
+                yield item
+        finally:
+            if chunk:
+                _write_chunk(chunk, path / f"{number:06}.npz")
+        shutil.rmtree(self._path(key), ignore_errors=True)
+        os.replace(path, self._path(key))
+        os.utime(self._path(key))
+        self._evict()
+
+    def _evict(self) -> None:
+        entries = sorted((path for path in self.directory.iterdir() if path.is_dir()),
+                         key=lambda path: path.stat().st_mtime)
+        sizes = {path: sum(chunk.stat().st_size for chunk in self._chunks(path)) for path in entries}
+        size = sum(sizes.values())
+        for path in entries:
+            if size <= self.max_size:
+                break
+            size -= sizes[path]
+            shutil.rmtree(path)
@@ -0,0 +1,75 @@
+import os
+import pickle
+from pathlib import Path
+from dataclasses import dataclass, field
+from typing import BinaryIO, Generator, List, Optional
+
+from bettercv.track import Track
+
+from .particle import Particle
+from .gating import ActivityGate
+from .bg_subtraction import BGState
+
+
+@dataclass
+class Checkpoint:
+    """
+    The state of a detection run, from which it can be resumed.
+
+    digest (str): Identifies the run's config, video and range, to avoid resuming a different run
+    index (int): The index of the last fully processed frame
+    tracks (List[Track]): The tracks which were still active after that frame
+    bg (BGState): The state of the BG model after that frame (for the BG methods which have one)
+    gate (ActivityGate): The activity gate after that frame (if it is enabled)
+    found (int): The size of the log of the particles found until that frame (see `log_particle`), in bytes
+    """
+    digest: str
+    index: int
+    tracks: List[Track] = field(default_factory=list)
+    bg: Optional[BGState] = None
+    gate: Optional[ActivityGate] = None
+    found: int = 0
+
+
+def save_checkpoint(checkpoint: Checkpoint, path: Path) -> None:
+    # Write to a temporary file first, so that a crash while saving keeps the previous checkpoint
+    temp_path = path.with_name(f".{path.name}.tmp")
+    with open(temp_path, "wb") as file:
+        pickle.dump(checkpoint, file)
+    os.replace(temp_path, path)
+
+
+def load_checkpoint(path: Path, digest: str) -> Optional[Checkpoint]:
+    """
+    Returns:
+        The checkpoint saved at the given path, or None if there is none for a run with the given digest
+    """
+    if not path.exists():
+        return None
+    with open(path, "rb") as file:
+        checkpoint = pickle.load(file)
+    return checkpoint if checkpoint.digest == digest else None
+
+
+def log_path(path: Path) -> Path:
+    """
+    The path of the log of the particles found by a run, next to its checkpoint.
+    The particles are appended to the log as they are found, so a checkpoint only needs the log's size,
+    and saving it doesn't take longer as more particles are found.
+    """
+    return path.with_name(f"{path.name}.log")
+
+
+def log_particle(particle: Particle, log: BinaryIO) -> None:
+    pickle.dump(particle, log)
+
+
+def read_log(log: BinaryIO, size: int) -> Generator[Particle, None, None]:
+    """
+    Reads the particles which were logged until a checkpoint (by its `found` size),
+    and drops those logged after it, which a resumed run finds again.
+    """
+    log.truncate(size)
+    log.seek(0)
+    while log.tell() < size:
+        yield pickle.load(log)
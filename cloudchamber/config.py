@@ -1,5 +1,16 @@
-from typing import Dict, Tuple
-from dataclasses import dataclass
+import json
+from hashlib import sha1
+from dataclasses import dataclass, fields
+from typing import Dict, Tuple, Iterable
+
+# Fields that don't affect the detection results
+_RUNTIME_FIELDS = ("checkpoint_interval", "prints", "display", "keep_track_history")
+# Fields that affect the prepared (preprocessed, gated and smoothed) frames
+PREPROCESSING_FIELDS = ("scale_factor", "crop_box", "blur_size",
+                        "gate_threshold", "gate_downscale", "gate_bg_jump", "gate_preroll", "coarse_scale")
+# Fields that affect the prominent contours found in each frame (i.e. everything before joining and tracking)
+CONTOUR_FIELDS = PREPROCESSING_FIELDS + ("bg_method", "bg_jump", "bg_batch_size", "bg_alpha",
+                                         "min_threshold", "min_contour_size", "roi_padding")
 
 
 @dataclass
@@ -8,10 +19,20 @@ class Config:
     blur_size: int = 15
     scale_factor: float = 0.6
     crop_box: Tuple[int, int, int, int] = (35, 20, 0, 0)
+    # Activity Gating
+    gate_threshold: float = 0  # Score (in gray levels) below which frames are skipped, 0 disables the gate
+    gate_downscale: int = 8  # The gate scores the frames shrunk by this factor
+    gate_bg_jump: int = 10  # Every n-th skipped frame still updates the BG model
+    gate_preroll: int = 500  # Every skipped frame among the first n frames still updates the BG model
+    # Coarse-to-fine Detection
+    coarse_scale: float = 1  # The scale (of the preprocessed frames) BG subtraction runs at, 1 disables coarse-to-fine
+    roi_padding: int = 20  # Pixels around each coarse candidate in which its contours are found at full resolution
     # BG computation
-    bg_method: str = "mog2"  # "mog2"/"avg"/"replace"
+    bg_method: str = "mog2"  # "mog2"/"avg"/"ema"/"median"/"replace"
     bg_jump: int = 5
     bg_batch_size: int = 200
+    bg_alpha: float = 0.02  # The weight of each update of the "ema" BG
+    bg_preroll: int = 500  # Frames used to warm up the BG model when starting mid-video
     # Thresholding
     min_threshold: int = 1
     # Contour Filtering
@@ -19,11 +40,15 @@ class Config:
     min_aspect_ratio: float = 3
     max_contour_width: int = 100
     # Contour Joining
+    join_method: str = "geometric"  # "geometric"/"morphological"
     dist_close: int = 30
     # Contour Tracking
     track_distance: int = 30
+    keep_track_history: bool = False  # Keep every snapshot of the tracks (for debugging), not only the best one
     # Track Filtering
     min_track_length: int = 10
+    # Checkpoints
+    checkpoint_interval: int = 1000  # Frames between checkpoints
     # Debugging
     prints: bool = True
     display: bool = False
@@ -31,3 +56,11 @@ class Config:
     @classmethod
     def merge(cls, config: "Dict") -> "Config":
         return cls(**config)
+
+    def digest(self, names: Iterable[str] = None) -> str:
+        """
+        A short hash of the given fields (by default, all fields that affect the detection results).
+        """
+        names = names or [field.name for field in fields(self) if field.name not in _RUNTIME_FIELDS]
+        values = {name: getattr(self, name) for name in names}
+        return sha1(json.dumps(values, sort_keys=True).encode()).hexdigest()[:16]
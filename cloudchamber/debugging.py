@@ -1,5 +1,6 @@
 from contextlib import ExitStack
-from typing import Iterable, Container, Callable, Sequence
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Iterable, Container, Callable, Sequence, Dict
 
 from bettercv.image import abc
 from bettercv.track import Track
@@ -15,6 +16,11 @@ from .processing import preprocess
 ESC = 27
 CLOSE_BTN = -1
 EXIT_CODES = {ESC, CLOSE_BTN}
+BACKSPACE = 8
+BACK_CODES = {ord("b"), BACKSPACE}
+
+PREFETCH_COUNT = 8  # Particles rendered in the background ahead of the displayed one
+BACK_STEPS = 16  # Rendered particles kept behind the displayed one, to step back to
 
 
 def exit_for(codes: Container[int]) -> Callable[[int], None]:
@@ -28,17 +34,39 @@ def display_image(image: Image, title: str) -> None:
     handle_key_code(Window(image, title).fit_to_screen().show())
 
 
+def _render_particle(videos: Dict[str, Video], particle: Particle, config: Config) -> Image:
+    frame = preprocess(videos[particle.snapshot.ref.video][particle.snapshot.ref.index], config)
+    return draw_contours(abc(frame.image), [particle.snapshot.contour])
+
+
 def display_particles(particles: Iterable[Particle], **config) -> None:
+    """
+    Displays each particle on its frame, in the order of the videos and frames.
+    Any key moves to the next particle, and B (or backspace) moves back to the previous one.
+
+    The next particles are rendered on a background thread (which reads the videos in order) while one is displayed,
+    and the last ones are kept, so moving in either direction hardly waits.
+    """
     config = Config.merge(config)
+    particles = sorted(particles, key=lambda particle: (str(particle.snapshot.ref.video), particle.snapshot.ref.index))
     with ExitStack() as stack:
         videos = {path: stack.enter_context(Video(path))
                   for path in {particle.snapshot.ref.video for particle in particles}}
-        for particle in particles:
-            frame = preprocess(videos[particle.snapshot.ref.video][particle.snapshot.ref.index], config)
-            display_image(
-                draw_contours(abc(frame.image), [particle.snapshot.contour]),
-                str(particle.snapshot)
-            )
+        # A single thread, since videos can't be read concurrently
+        executor = ThreadPoolExecutor(1)
+        stack.callback(executor.shutdown, cancel_futures=True)
+        rendered: Dict[int, Future] = {}
+        position = 0
+        while position < len(particles):
+            for index in range(position, min(position + PREFETCH_COUNT + 1, len(particles))):
+                if index not in rendered:
+                    rendered[index] = executor.submit(_render_particle, videos, particles[index], config)
+            kept = range(position - BACK_STEPS, position + PREFETCH_COUNT + 1)
+            for index in [index for index in rendered if index not in kept]:
+                rendered.pop(index).cancel()
+            key_code = Window(rendered[position].result(), str(particles[position].snapshot)).fit_to_screen().show()
+            handle_key_code(key_code)
+            position = max(position - 1, 0) if key_code in BACK_CODES else position + 1
 
 
 def display_frame(frame: Frame) -> Frame:
@@ -52,6 +80,10 @@ def display_contours(frame: Frame, contours: Sequence[Contour]) -> Frame:
 
 
 def display_track(track: Track, **config) -> Track:
+    """
+    Displays the snapshots of a track, which are all of its frames only if it kept its history
+    (see `Config.keep_track_history`).
+    """
     config = Config.merge(config)
     with Video(track[0].ref.video) as video:
         for snapshot in track:
@@ -1,16 +1,43 @@
+import math
+import cv2 as cv
+import numpy as np
 from pathlib import Path
-from typing import Iterable, Sequence, MutableSequence, List
+from itertools import chain, tee
+from dataclasses import dataclass
+from typing import Iterable, Sequence, List, Generator, Tuple, Callable
 
+import bettercv.image as img
+from bettercv import profiling
 from bettercv.track import Track
 from bettercv.video import Video, Frame
-from bettercv.contours import Contour, find_contours, join_close_contours
+from bettercv.contours import (Contour, find_contours, join_contours,
+                               group_close_contours, group_contours_by_dilation)
 
 import cloudchamber.debugging as dbg
 
 from .config import Config
 from .particle import Particle
-from .bg_subtraction import subtract_bg
-from .processing import preprocess, smooth
+from .tracking import Tracker
+from .cache import ContourCache, CachedFrame
+from .gating import ActivityGate
+from .features import backfill_features
+from .checkpoint import Checkpoint, save_checkpoint, load_checkpoint, log_path, log_particle, read_log
+from .bg_subtraction import BGState, STATEFUL_METHODS, subtract_bg
+from .processing import Preprocessor, smooth, smooth_coarse
+
+
+@dataclass
+class Detection:
+    """
+    The prominent contours found in a frame, before they are joined and tracked.
+
+    frame (Frame): The preprocessed frame, to measure features on (without an image when replayed from a cache)
+    shape (Tuple[int, ...]): The shape of the frame's image
+    contours (Sequence[Contour]): The prominent contours found in the frame
+    """
+    frame: Frame
+    shape: Tuple[int, ...]
+    contours: Sequence[Contour]
 
 
 def find_prominent_contours(binary: Frame, min_size: int) -> Sequence[Contour]:
@@ -19,56 +46,363 @@ def find_prominent_contours(binary: Frame, min_size: int) -> Sequence[Contour]:
                  if contour.area > min_size)
 
 
+def find_regions(binary: Frame, config: Config) -> List[Tuple[int, int, int, int]]:
+    """
+    The regions around the prominent contours of a coarse binary frame (padded by `roi_padding`),
+    with overlapping regions merged, as (x, y, width, height) in the coarse frame.
+    """
+    padding = math.ceil(config.roi_padding * config.coarse_scale)
+    mask = np.zeros_like(binary.image)
+    for contour in find_prominent_contours(binary, config.min_contour_size * config.coarse_scale ** 2):
+        x, y, width, height = contour.bounding_rect
+        cv.rectangle(mask, (x - padding, y - padding), (x + width - 1 + padding, y + height - 1 + padding),
+                     img.MAX_PIXEL_VALUE, -1)
+    return [region.bounding_rect for region in find_contours(mask, external_only=True)]
+
+
+def refine_contours(binary: Frame, source: Frame, config: Config) -> Sequence[Contour]:
+    """
+    Finds the prominent contours of a frame at full resolution, but only inside the regions around
+    the contours of its coarse binary frame (see `find_regions`).
+    Each region is smoothed and thresholded on its own, and restricted to the (slightly dilated) coarse foreground,
+    so nearby bright pixels which aren't part of a candidate aren't picked up.
+    """
+    height, width = source.image.shape[:2]
+    # The coarse foreground is grown by a full-resolution pixel on each side of every coarse pixel
+    grow = cv.getStructuringElement(cv.MORPH_ELLIPSE, (2 * math.ceil(1 / config.coarse_scale) + 1,) * 2)
+    contours = []
+    for x, y, region_width, region_height in find_regions(binary, config):
+        left, top = int(x / config.coarse_scale), int(y / config.coarse_scale)
+        right = min(math.ceil((x + region_width) / config.coarse_scale), width)
+        bottom = min(math.ceil((y + region_height) / config.coarse_scale), height)
+        smoothed = img.blur(source.image[top:bottom, left:right], (config.blur_size, config.blur_size))
+        foreground = cv.dilate(cv.resize(binary.image[y:y + region_height, x:x + region_width],
+                                         (right - left, bottom - top), interpolation=cv.INTER_NEAREST), grow)
+        refined = cv.bitwise_and(img.threshold_otsu(smoothed)[1], foreground)
+        contours.extend(contour for contour in find_contours(refined, external_only=True, offset=(left, top))
+                        if contour.area > config.min_contour_size)
+    return tuple(contours)
+
+
 def retain_track_like(contours: Iterable[Contour], config: Config) -> Iterable[Contour]:
     return (contour for contour in contours
             if (contour.length / contour.width > config.min_aspect_ratio)
             and (contour.width < config.max_contour_width))
 
 
+def group_contours(contours: Sequence[Contour], shape: Tuple[int, ...], config: Config) -> List[List[int]]:
+    match config.join_method:
+        case "geometric":
+            return group_close_contours(contours, config.dist_close)
+        case "morphological":
+            return group_contours_by_dilation(contours, shape, config.dist_close)
+
+
+def join_close(contours: Sequence[Contour], shape: Tuple[int, ...], config: Config) -> Sequence[Contour]:
+    return [join_contours([contours[index] for index in group])
+            for group in group_contours(contours, shape, config)]
+
+
 def find_close_tracks(contour: Contour, index: int, tracks: Iterable[Track], track_distance: int) -> List[Track]:
     return list(track for track in tracks
                 if (track.end.contour.centroid.distance_to(contour.centroid) < track_distance)
                 and (index - track.end.ref.index == 1))
 
 
-def update_tracks(tracks: MutableSequence[Track],
-                  contours: Iterable[Contour],
-                  binary: Frame,
-                  config: Config) -> None:
-    for contour in contours:
-        close = find_close_tracks(contour, binary.ref.index, tracks, config.track_distance)
-        if len(close) > 1:
-            # raise Exception("Multiple tracks detected for same contour!")
-            pass
-        if len(close) == 1:
-            close[0].record(contour, binary)
-        else:
-            new_track = Track()
-            new_track.record(contour, binary)
-            tracks.append(new_track)
+def prepare(frames: Iterable[Frame], config: Config,
+            gate: ActivityGate = None) -> Generator[Tuple[Frame, Frame], None, None]:
+    """
+    Yields the preprocessed frames, each with its smoothed version (which the BG is subtracted from).
+    If the activity gate is enabled, quiet frames are skipped, except for those which only update the BG model.
+    These come without a preprocessed image, since there is nothing to detect in them.
+    An existing gate can be given to continue from its state.
+    """
+    gated = (profiling.iterate("gate", (gate or ActivityGate(config)).gate(frames)) if config.gate_threshold
+             else ((frame, False) for frame in frames))
+    preprocessor = None
+    for frame, quiet in gated:
+        with profiling.span("preprocess"):
+            preprocessor = preprocessor or Preprocessor(frame.image.shape, config)
+            source = preprocessor(frame)
+        with profiling.span("smooth"):
+            smoothed = smooth(source, config) if config.coarse_scale == 1 else smooth_coarse(source, config)
+        yield source.with_image(None) if quiet else source, smoothed
+
+
+def subtract_prepared(prepared: Iterable[Tuple[Frame, Frame]], config: Config,
+                      state: BGState = None) -> Generator[Tuple[Frame, Frame], None, None]:
+    """
+    Yields the binary (BG subtracted) frames, each with the preprocessed frame it was computed from.
+    The preprocessed frame is kept so features can be measured on it.
+
+    Args:
+        prepared: Pairs of preprocessed and smoothed frames (see `prepare`)
+        config: The detection config
+        state: The state of the BG model to continue from (see `BGState`)
+    """
+    prepared, sources = tee(prepared)
+    binaries = profiling.iterate("subtract_bg", subtract_bg((smoothed for _, smoothed in prepared), config, state))
+    sources = (source for source, _ in sources)
+    for binary in binaries:
+        # Some BG methods drop frames without tracks
+        source = next(sources)
+        while source.ref.index != binary.ref.index:
+            source = next(sources)
+        yield binary, source
+
+
+def binaries_with_sources(frames: Iterable[Frame], config: Config) -> Generator[Tuple[Frame, Frame], None, None]:
+    return subtract_prepared(prepare(frames, config), config)
+
+
+def detect_binaries(binaries: Iterable[Tuple[Frame, Frame]],
+                    config: Config,
+                    since: int = None) -> Generator[Detection, None, None]:
+    """
+    Yields the prominent contours found in the given binary frames (each with its source, as yielded by
+    `binaries_with_sources`). Frames before `since` and quiet frames (without a source image, see `prepare`)
+    only fed the background model (e.g. to warm it up), and are skipped.
+    With coarse-to-fine detection, the binary frames are coarse, and the contours are refined on the sources.
+    """
+    for binary, source in binaries:
+        if (since is None or binary.ref.index >= since) and source.image is not None:
+            with profiling.span("find_contours"):
+                if config.coarse_scale == 1:
+                    contours = find_prominent_contours(binary, config.min_contour_size)
+                else:
+                    contours = refine_contours(binary, source, config)
+            profiling.count("frames")
+            profiling.count("contours", len(contours))
+            yield Detection(source, source.image.shape, contours)
+
+
+def iter_detections(frames: Iterable[Frame], config: Config, since: int = None) -> Generator[Detection, None, None]:
+    return detect_binaries(binaries_with_sources(frames, config), config, since)
+
+
+def track_detections(detections: Iterable[Detection],
+                     config: Config,
+                     tracker: Tracker = None,
+                     on_frame: Callable[[Frame], None] = None) -> Generator[Track, None, None]:
+    """
+    Joins and tracks the detected contours, and yields each track as soon as it can't be continued.
+    An existing tracker can be given to continue its tracks, and `on_frame` is called after each tracked frame
+    (once the tracks it retired were consumed).
+    """
+    tracker = tracker or Tracker(config.track_distance, keep_history=config.keep_track_history)
+    for detection in detections:
+        with profiling.span("join"):
+            contours = tuple(retain_track_like(join_close(detection.contours, detection.shape, config), config))
+        with profiling.span("track"):
+            retired = tracker.update(contours, detection.frame)
+        profiling.count("tracks", len(retired))
+        yield from retired
+        if on_frame:
+            on_frame(detection.frame)
+    retired = tracker.flush()
+    profiling.count("tracks", len(retired))
+    yield from retired
+
+
+def iter_tracks(frames: Iterable[Frame],
+                config: Config,
+                since: int = None,
+                tracker: Tracker = None,
+                on_frame: Callable[[Frame], None] = None) -> Generator[Track, None, None]:
+    """
+    Tracks the contours found in the given frames (see `iter_detections` and `track_detections`).
+    """
+    return track_detections(iter_detections(frames, config, since), config, tracker, on_frame)
+
+
+def find_tracks(frames: Iterable[Frame], config: Config, since: int = None) -> List[Track]:
+    return list(iter_tracks(frames, config, since))
+
+
+def to_particles(tracks: Iterable[Track], config: Config) -> Generator[Particle, None, None]:
+    for track in tracks:
+        if track.extent > config.min_track_length:
+            profiling.count("particles")
+            yield Particle.from_track(track)
+
+
+def iter_particles(frames: Iterable[Frame], config: Config, since: int = None) -> Generator[Particle, None, None]:
+    """
+    Yields the particles found in the given frames as soon as their tracks end,
+    so that only the tracks which are still active are kept in memory.
+    """
+    return to_particles(iter_tracks(frames, config, since), config)
 
 
 def detect_tracks(frames: Iterable[Frame], **config) -> List[Particle]:
-    tracks: List[Track] = []
+    return list(iter_particles(frames, Config.merge(config)))
+
+
+def can_warm_up(config: Config) -> bool:
+    """
+    Whether the BG model can be rebuilt by warming it up on the frames before a given one (see `warm_up_start`).
+    It is rebuilt exactly with "avg" (by re-reading the whole batch), and approximated with "mog2" and "median",
+    which converge to the same BG within the pre-roll.
+    "replace" keeps the BG it last replaced, which may be any earlier frame, and "ema" converges too slowly.
+    The "avg" batches are only aligned with those of a run from the start if no frames are gated out.
+    """
+    if config.bg_method == "avg":
+        return not config.gate_threshold
+    return config.bg_method not in ("replace", "ema")
+
+
+def can_resume(config: Config) -> bool:
+    """
+    Whether a run can be resumed from a checkpoint: the BG model's state is either saved or warmed up again.
+    """
+    return config.bg_method in STATEFUL_METHODS or can_warm_up(config)
+
+
+def warm_up_start(start: int, index: int, config: Config) -> int:
+    """
+    The index to start reading from, in order to track from `index` as if reading had started at `start`
+    (see `can_warm_up`).
+    """
+    if config.bg_method == "avg":
+        # Re-read the whole BG batch of the index, so the batches (and their BGs) are the same
+        return index - (index - start) % config.bg_batch_size
+    return max(start, index - config.bg_preroll)
+
+
+def warm_up_stop(start: int, index: int, stop: int, config: Config) -> int:
+    """
+    The index to stop reading at, in order to track until `index` as if reading had continued until `stop`.
+    """
+    if config.bg_method == "avg":
+        # Read the rest of the BG batch of the last tracked frame, so the batch (and its BG) is the same
+        return min(index + (start - index) % config.bg_batch_size, stop)
+    return index
+
+
+def _resume_video(video: Video, start: int, stop: int, path: Path, config: Config) -> Generator[Particle, None, None]:
+    """
+    Streams the particles of a video while saving periodic checkpoints, resuming from the last one if there is one.
+    The BG methods which have a state (see `BGState`) and the activity gate continue from their saved states,
+    so a resumed run finds the same particles as an uninterrupted one. The "avg" BG re-reads its whole batch,
+    which is as exact, while "mog2" is warmed up again on the frames before the checkpoint (which only approximates it).
+    """
+    digest = f"{config.digest()}:{video.path.resolve()}:{start}:{stop}"
+    checkpoint = load_checkpoint(path, digest) or Checkpoint(digest, start - 1)
+    tracker = Tracker(config.track_distance, checkpoint.tracks, config.keep_track_history)
+    resume = checkpoint.index + 1
+    # The saved states only apply when no frames before the checkpoint are read again
+    restore = config.bg_method in STATEFUL_METHODS
+    if not can_resume(config):
+        raise ValueError(f"A run with the {config.bg_method} BG and the activity gate can't be resumed!")
+    bg = (checkpoint.bg if restore else None) or BGState()
+    gate = ((checkpoint.gate if restore else None) or ActivityGate(config)) if config.gate_threshold else None
+    saved_index = checkpoint.index
+
+    def on_frame(binary: Frame) -> None:
+        nonlocal saved_index
+        checkpoint.index = binary.ref.index
+        if checkpoint.index - saved_index >= config.checkpoint_interval:
+            log.flush()
+            checkpoint.tracks, checkpoint.bg, checkpoint.gate, checkpoint.found = tracker.active, bg, gate, log.tell()
+            save_checkpoint(checkpoint, path)
+            saved_index = checkpoint.index
+
+    particles_path = log_path(path)
+    with open(particles_path, "r+b" if checkpoint.found else "w+b") as log:
+        yield from read_log(log, checkpoint.found)
+        frames = video.iter_frames(start=resume if restore else warm_up_start(start, resume, config), stop=stop)
+        detections = detect_binaries(subtract_prepared(prepare(frames, config, gate), config, bg), config, resume)
+        for particle in to_particles(track_detections(detections, config, tracker, on_frame), config):
+            log_particle(particle, log)
+            yield particle
+    path.unlink(missing_ok=True)
+    particles_path.unlink()
+
+
+def _cached_video(video: Video, start: int, stop: int,
+                  cache: ContourCache, config: Config) -> Generator[Particle, None, None]:
+    """
+    Streams the particles of a video, replaying the detected contours from the cache if they are there,
+    or recording them into the cache otherwise.
+    An interrupted recording is continued: its contours are replayed, and the BG model is warmed up again
+    on the frames before the first one it is missing. If the BG model can't be warmed up (see `can_warm_up`),
+    the recording starts over instead.
+    Replayed frames have no images, so the features of their particles are missing (see `backfill_features`).
+    """
+    def replay(cached: Iterable[CachedFrame]) -> Generator[Detection, None, None]:
+        return (Detection(Frame(None, ref), shape, contours) for ref, shape, contours in cached)
+
+    key = cache.key(video.path, start, stop, config)
+    cached = cache.load(key)
+    if cached is not None:
+        yield from to_particles(track_detections(replay(cached), config), config)
+        return
+    if not can_warm_up(config):
+        cache.discard(key)
+    recorded = cache.load(key, complete=False) or ()
+    until = cache.recorded_until(key)
+    resume = start if until is None else until + 1
+    frames = video.iter_frames(start=warm_up_start(start, resume, config), stop=stop)
+    detections = cache.record(key, iter_detections(frames, config, resume),
+                              lambda detection: (detection.frame.ref, detection.shape, detection.contours))
+    yield from to_particles(track_detections(chain(replay(recorded), detections), config), config)
+
+
+def stream_video(path: Path, start: int = 0, stop: int = None,
+                 checkpoint: Path = None, cache: ContourCache = None, **config) -> Generator[Particle, None, None]:
+    """
+    Yields the particles found in a video, between the given times (in seconds).
+    If a checkpoint path is given, the run is resumable (see `_resume_video`).
+    If a cache is given instead, the detected contours are cached (see `_cached_video`).
+    """
+    if checkpoint and cache:
+        raise ValueError("A run can't be both resumable and cached!")
     config = Config.merge(config)
-    frames = subtract_bg((smooth(preprocess(frame, config), config) for frame in frames), config)
-    for binary in frames:
-        contours = retain_track_like(
-            join_close_contours(
-                find_prominent_contours(binary, config.min_contour_size),
-                config.dist_close
-            ), config
-        )
-        update_tracks(tracks, contours, binary, config)
-    return list(map(
-        Particle.from_track,
-        [track for track in tracks if track.extent > config.min_track_length]
-    ))
-
-
-def analyze_video(path: Path, start: int = 0, stop: int = None, **config) -> List[Particle]:
     with Video(path) as video:
-        return detect_tracks(video.iter_frames(
-            start=video.index_at(start),
-            stop=video.index_at(stop) if stop else None
-        ), **config)
+        start = video.index_at(start)
+        stop = video.index_at(stop) if stop else None
+        if checkpoint:
+            yield from _resume_video(video, start, stop, checkpoint, config)
+        elif cache:
+            yield from _cached_video(video, start, stop, cache, config)
+        else:
+            yield from iter_particles(video.iter_frames(start=start, stop=stop), config)
+
+
+def analyze_video(path: Path, start: int = 0, stop: int = None,
+                  checkpoint: Path = None, cache: ContourCache = None, **config) -> List[Particle]:
+    particles = list(stream_video(path, start, stop, checkpoint, cache, **config))
+    backfill_features((particle.snapshot for particle in particles), Config.merge(config))
+    return particles
+
+
+@dataclass
+class JoinComparison:
+    frames: int = 0
+    frames_to_join: int = 0
+    disagreements: int = 0
+
+    def __str__(self) -> str:
+        rate = self.disagreements / self.frames_to_join if self.frames_to_join else 0
+        return (f"{self.disagreements} disagreements in {self.frames_to_join} frames with multiple contours "
+                f"({rate:.2%}), out of {self.frames} frames")
+
+
+def compare_join_methods(frames: Iterable[Frame], **config) -> JoinComparison:
+    """
+    Counts the frames in which the geometric and morphological join methods group the contours differently.
+    """
+    config = Config.merge(config)
+    comparison = JoinComparison()
+    for detection in iter_detections(frames, config):
+        comparison.frames += 1
+        if len(detection.contours) < 2:
+            continue
+        comparison.frames_to_join += 1
+        geometric = group_close_contours(detection.contours, config.dist_close)
+        morphological = group_contours_by_dilation(detection.contours, detection.shape, config.dist_close)
+        if geometric != morphological:
+            comparison.disagreements += 1
+            if config.prints:
+                print(f"{detection.frame}: geometric {geometric}, morphological {morphological}")
+    return comparison
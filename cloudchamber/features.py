@@ -0,0 +1,41 @@
+from itertools import groupby
+from collections import defaultdict
+from typing import Callable, Dict, Iterable, List
+
+from bettercv.types import Image
+from bettercv.video import Video
+from bettercv.track import Snapshot
+from bettercv.contours import Contour
+
+from .config import Config
+from .processing import preprocess_frames
+
+# Pixel-based features, measured on the preprocessed (unsmoothed) frame
+FEATURES: Dict[str, Callable[[Contour, Image], float]] = {
+    "intensity": Contour.mean_value,
+}
+
+
+def measure_features(contour: Contour, image: Image) -> Dict[str, float]:
+    return {name: measure(contour, image) for name, measure in FEATURES.items()}
+
+
+def _video_key(snapshot: Snapshot) -> str:
+    return str(snapshot.ref.video)
+
+
+def backfill_features(snapshots: Iterable[Snapshot], config: Config = None) -> None:
+    """
+    Measures the features of snapshots which are missing them (e.g. ones loaded from older files).
+    Each video is read once, sequentially, in order of the frames needed.
+    """
+    config = config or Config()
+    missing = sorted((snapshot for snapshot in snapshots if set(FEATURES) - set(snapshot.features)), key=_video_key)
+    for path, video_snapshots in groupby(missing, key=_video_key):
+        by_index: Dict[int, List[Snapshot]] = defaultdict(list)
+        for snapshot in video_snapshots:
+            by_index[snapshot.ref.index].append(snapshot)
+        with Video(path) as video:
+            for frame in preprocess_frames(video.iter_frames_at(sorted(by_index)), config):
+                for snapshot in by_index[frame.ref.index]:
+                    snapshot.features.update(measure_features(snapshot.contour, frame.image))
@@ -0,0 +1,73 @@
+import math
+import cv2 as cv
+import numpy as np
+from typing import Iterable, Generator, Tuple
+
+import bettercv.image as img
+from bettercv.video import Frame
+
+from .config import Config
+
+# How fast the gate's background follows the quiet frames
+GATE_ALPHA = 0.05
+
+
+class ActivityGate:
+    """
+    Cheaply finds the quiet frames, which can't contain tracks, so they can skip the full processing
+    (including the preprocessing).
+    A frame is scored by the largest difference between a heavily shrunk copy of the region kept by the crop box
+    and a running average of the previous quiet copies, and it is quiet if its score is below the threshold
+    (in gray levels).
+
+    frames (int): The number of frames gated so far
+    skipped (int): The number of quiet frames whose detection was skipped so far
+    """
+
+    def __init__(self, config: Config) -> None:
+        self.config = config
+        self.frames = 0
+        self.skipped = 0
+        self._region = None
+        self._small = None
+        self._bg = None
+
+    def _crop_region(self, shape: Tuple[int, ...]) -> Tuple[slice, slice]:
+        height, width = shape[:2]
+        top, bottom, left, right = (math.ceil(margin / self.config.scale_factor) for margin in self.config.crop_box)
+        return slice(top, height - bottom), slice(left, width - right)
+
+    def score(self, frame: Frame) -> float:
+        self._region = self._region or self._crop_region(frame.image.shape)
+        # Shrinking by an integer factor takes OpenCV's fast path
+        shrink = 1 / self.config.gate_downscale
+        self._small = cv.resize(frame.image[self._region], None, self._small, shrink, shrink, cv.INTER_AREA)
+        small = self._small if img.is_grayscale(self._small) else img.grayscale(self._small)
+        if self._bg is None:
+            self._bg = small.astype(np.float32)
+        score = float(np.abs(small - self._bg).max())
+        # Only quiet frames update the background, so tracks don't linger in it after they fade
+        if score < self.config.gate_threshold:
+            cv.accumulateWeighted(small, self._bg, GATE_ALPHA)
+        return score
+
+    def gate(self, frames: Iterable[Frame]) -> Generator[Tuple[Frame, bool], None, None]:
+        """
+        Yields the frames which may contain tracks, and every `gate_bg_jump`-th quiet frame,
+        so the BG model keeps up with the quiet stretches (at a fraction of the cost).
+        All the quiet frames in the first `gate_preroll` frames are yielded, since a BG model which has seen
+        fewer frames may also learn faster (e.g. MOG2), and absorb tracks into the BG.
+
+        Returns:
+            Pairs of a frame and whether it is quiet (i.e. should only update the BG model)
+        """
+        for frame in frames:
+            self.frames += 1
+            if self.score(frame) >= self.config.gate_threshold:
+                yield frame, False
+                continue
+            self.skipped += 1
+            if self.frames <= self.config.gate_preroll or self.skipped % self.config.gate_bg_jump == 0:
+                yield frame, True
+        if self.config.prints:
+            print(f"Activity gate skipped {self.skipped} of {self.frames} frames")
@@ -0,0 +1,92 @@
+import os
+from pathlib import Path
+from itertools import repeat, takewhile
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Sequence, Tuple
+
+from bettercv.track import Track
+from bettercv.video import Video, Frame
+
+from .config import Config
+from .particle import Particle
+from .tracking import Tracker
+from .detection import (iter_detections, track_detections, find_close_tracks, to_particles,
+                        can_warm_up, warm_up_start, warm_up_stop)
+
+# A segment is the range of frames it owns: [start, stop)
+Segment = Tuple[int, int]
+
+
+def split_range(start: int, stop: int, segments: int) -> List[Segment]:
+    bounds = [start + (stop - start) * index // segments for index in range(segments + 1)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def track_segment(path: Path, segment: Segment, first: int, last: int, config: Config) -> List[Track]:
+    """
+    Tracks the frames of a single segment.
+    The frames between `first` and the start of the segment overlap the previous segment,
+    and are only used to warm up the background model.
+    The frames between the end of the segment and `last` overlap the next segment,
+    and are only read to complete the background model of the segment's last frames.
+    """
+    tracker = Tracker(config.track_distance, keep_history=config.keep_track_history)
+    # The tracks which start on the segment's first frame, in the order of their contours
+    starting = []
+
+    def on_frame(frame: Frame) -> None:
+        if frame.ref.index == segment[0]:
+            starting.extend(tracker.active)
+
+    with Video(path) as video:
+        detections = iter_detections(video.iter_frames(start=first, stop=last), config, since=segment[0])
+        tracks = list(track_detections(takewhile(lambda detection: detection.frame.ref.index < segment[1],
+                                                 detections), config, tracker, on_frame))
+    # Tracks are retired in the order they end, but a serial run matches the contours of a frame in their order
+    return starting + [track for track in tracks if track not in starting]
+
+
+def stitch_tracks(segments: Sequence[Segment], tracks: Sequence[List[Track]], track_distance: int) -> List[Track]:
+    """
+    Joins the tracks of consecutive segments.
+    A track that starts at the beginning of a segment continues a track from the previous segment
+    if it would have done so in a serial run, i.e. if it is close to exactly one track that ended
+    on the previous frame (and was not already continued).
+    """
+    stitched = list(tracks[0])
+    for (boundary, _), segment_tracks in zip(segments[1:], tracks[1:]):
+        candidates = [track for track in stitched if track.end.ref.index == boundary - 1]
+        # A serial run matches tracks in the order they start (and then by their contours' order, see `track_segment`)
+        for track in sorted(segment_tracks, key=lambda track: track.start.ref.index):
+            close = find_close_tracks(track.start.contour, track.start.ref.index, candidates, track_distance)
+            if len(close) == 1:
+                close[0].extend(track)
+                candidates.remove(close[0])
+            else:
+                stitched.append(track)
+    return stitched
+
+
+def analyze_video_parallel(path: Path, start: int = 0, stop: int = None,
+                           segments: int = None, **config) -> List[Particle]:
+    """
+    Like `analyze_video`, but splits the video into segments which are tracked in parallel processes.
+    Each segment (except for the first) is preceded by frames to warm up the background model (see `warm_up_start`),
+    and with an averaged background, followed by the rest of its last background batch (see `warm_up_stop`).
+    The particles are the same as a serial run's with "avg", and approximately the same with "mog2" and "median",
+    whose warm-up only approximates their state. Other BG methods can't be warmed up (see `can_warm_up`).
+    """
+    config = Config.merge(config)
+    if not can_warm_up(config):
+        raise ValueError(f"Segments can't warm up the {config.bg_method} BG (see `can_warm_up`)!")
+    with Video(path) as video:
+        first = video.index_at(start)
+        last = video.index_at(stop) if stop else video.frame_num
+    # Segments shorter than the pre-roll spend more time warming up than tracking
+    segments = max(1, min(segments or os.cpu_count(), (last - first) // max(config.bg_preroll, 1)))
+    ranges = split_range(first, last, segments)
+    firsts = [warm_up_start(first, segment[0], config) for segment in ranges]
+    lasts = [warm_up_stop(first, segment[1], last, config) for segment in ranges]
+    with ProcessPoolExecutor(segments) as executor:
+        tracks = list(executor.map(track_segment, repeat(path), ranges, firsts, lasts, repeat(config)))
+    return list(to_particles(stitch_tracks(ranges, tracks, config.track_distance), config))
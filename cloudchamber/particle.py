@@ -1,12 +1,12 @@
-from typing import Tuple
+import numpy as np
 from dataclasses import dataclass
+from typing import Tuple, Dict, Sequence
 
-from bettercv.image import mean
-from bettercv.video import Ref, Video
+from bettercv.video import Ref
 from bettercv.track import Track, Snapshot
+from bettercv.contours import fit_parabolas
 
-from .config import Config
-from .processing import preprocess
+from .features import backfill_features
 
 
 @dataclass
@@ -40,9 +40,10 @@ class Particle:
 
     @property
     def intensity(self) -> float:
-        with Video(self.snapshot.ref.video) as video:
-            frame = preprocess(video[self.snapshot.ref.index], Config)
-        return mean(frame.image, self.snapshot.contour.create_mask(frame.image.shape))[0]
+        if "intensity" not in self.snapshot.features:
+            # Prefer `backfill_features` on all particles at once, which reads each video only once
+            backfill_features([self.snapshot])
+        return self.snapshot.features["intensity"]
 
     @property
     def type(self) -> str:
@@ -50,10 +51,68 @@ class Particle:
 
     @classmethod
     def from_track(cls, track: Track) -> "Particle":
-        best_snapshot = max(track.snapshots, key=_snapshot_maximizer)
+        # Tracks from the tracker keep their best snapshot as they go (see `snapshot_score`)
+        best_snapshot = track.best if track.key is snapshot_score else max(track.snapshots, key=snapshot_score)
         # best_snapshot = track.snapshots[min(len(track.snapshots) - 1, 4)]
         return cls((track.start.ref, track.end.ref), best_snapshot)
 
 
-def _snapshot_maximizer(snapshot: Snapshot) -> float:
+def snapshot_score(snapshot: Snapshot) -> float:
+    """
+    How well a snapshot shows its particle, which chooses the snapshot of a track that its particle keeps.
+    """
     return snapshot.contour.length / snapshot.contour.width
+
+
+@dataclass
+class ParticleTable:
+    """
+    The features of many particles, computed once for all of them (vectorized where possible),
+    and stored as columns next to the particles.
+
+    particles (Sequence[Particle]): The particles, in the order of the columns' rows
+    columns (Dict[str, ndarray]): An array for each of `COLUMNS`, e.g. `table["length"]`
+    """
+    COLUMNS = ("width", "length", "angle", "curvature", "intensity",
+               "start_index", "start_time", "end_index", "end_time", "snapshot_index", "snapshot_time")
+
+    particles: Sequence[Particle]
+    columns: Dict[str, np.ndarray]
+
+    def __len__(self) -> int:
+        return len(self.particles)
+
+    def __getitem__(self, column: str) -> np.ndarray:
+        return self.columns[column]
+
+    @classmethod
+    def from_particles(cls, particles: Sequence[Particle]) -> "ParticleTable":
+        contours = [particle.snapshot.contour for particle in particles]
+        rects = [contour.min_area_rect for contour in contours]
+        axes = np.array([rect[1] for rect in rects], dtype=np.float64).reshape(-1, 2)
+        angles = np.array([rect[2] for rect in rects], dtype=np.float64)
+        points = [contour.points.reshape(-1, 2) for contour in contours]
+        offsets = np.cumsum([0] + [len(contour) for contour in points], dtype=np.int64)
+        curvatures = np.abs(fit_parabolas(np.concatenate(points) if points else np.empty((0, 2)), offsets)[:, 0])
+        columns = {"width": axes.min(axis=1),
+                   "length": axes.max(axis=1),
+                   "angle": angles + np.where(axes[:, 0] < axes[:, 1], 90, 0),
+                   "curvature": curvatures,
+                   "intensity": np.array([particle.snapshot.features.get("intensity", np.nan)
+                                          for particle in particles], dtype=np.float64)}
+        for name, refs in (("start", [particle.start for particle in particles]),
+                           ("end", [particle.end for particle in particles]),
+                           ("snapshot", [particle.snapshot.ref for particle in particles])):
+            columns[f"{name}_index"] = np.array([ref.index for ref in refs], dtype=np.int64)
+            columns[f"{name}_time"] = np.array([ref.timestamp for ref in refs], dtype=np.float64)
+        return cls(particles, columns)
+
+    def backfill_features(self) -> None:
+        """
+        Backfills the intensity of the particles which are missing it (see `backfill_features`), in the column too.
+        """
+        missing = np.flatnonzero(np.isnan(self.columns["intensity"]))
+        if len(missing):
+            snapshots = [self.particles[index].snapshot for index in missing.tolist()]
+            backfill_features(snapshots)
+            self.columns["intensity"][missing] = [snapshot.features["intensity"] for snapshot in snapshots]
@@ -1,8 +1,15 @@
+import cv2 as cv
+from fractions import Fraction
+from typing import Iterable, Generator, Tuple
+
 import bettercv.image as img
 from bettercv.video import Frame
 
 from .config import Config
 
+# The largest number of source pixels in a period of the scaling grid (see `_scaled_span`)
+_MAX_PERIOD = 1000
+
 
 def preprocess(frame: Frame, config: Config) -> Frame:
     return frame.with_image(
@@ -12,3 +19,70 @@ def preprocess(frame: Frame, config: Config) -> Frame:
 
 def smooth(frame: Frame, config: Config) -> Frame:
     return frame.with_image(img.blur(frame.image, (config.blur_size, config.blur_size)))
+
+
+def smooth_coarse(frame: Frame, config: Config) -> Frame:
+    """
+    Shrinks the preprocessed frame to the coarse scale, and blurs it with a kernel shrunk to match.
+    """
+    size = max(round(config.blur_size * config.coarse_scale) // 2 * 2 + 1, 1)
+    return frame.with_image(img.blur(img.scale(frame.image, config.coarse_scale), (size, size)))
+
+
+def _scaled_span(length: int, start: int, stop: int, factor: float) -> Tuple[slice, slice]:
+    """
+    The source pixels to scale down, so that the scaled pixels [start, stop) are the same as when scaling the whole
+    axis, and where these pixels are within the scaled span.
+    Scaling by p/q maps each q source pixels to p scaled pixels, so the span is aligned to this grid,
+    and padded by a period on each side so its edges don't affect the kept pixels.
+    """
+    period = Fraction(factor).limit_denominator(_MAX_PERIOD)
+    first = max(0, (start // period.numerator - 1) * period.numerator)
+    last = (-(-stop // period.numerator) + 1) * period.numerator
+    source = slice(first * period.denominator // period.numerator,
+                   min(length, last * period.denominator // period.numerator))
+    return source, slice(start - first, stop - first)
+
+
+class Preprocessor:
+    """
+    Preprocesses the frames of a video exactly like `preprocess`, with less work and fewer allocations.
+    When scaling down, only the part of the frame kept by the crop box is scaled, and the scaled image is written
+    into a buffer which is reused between frames.
+    Only the grayscale image is allocated for each frame, since it outlives the call (e.g. in BG batches).
+    """
+
+    def __init__(self, shape: Tuple[int, ...], config: Config) -> None:
+        height, width = shape[:2]
+        top, bottom, left, right = config.crop_box
+        self.factor = config.scale_factor
+        rows = (top, round(height * self.factor) - bottom)
+        columns = (left, round(width * self.factor) - right)
+        if self.factor < 1:
+            (source_rows, rows), (source_columns, columns) = (_scaled_span(height, *rows, self.factor),
+                                                              _scaled_span(width, *columns, self.factor))
+            self.source = (source_rows, source_columns)
+            self.crop = (rows, columns)
+        else:
+            # Linear interpolation isn't exactly periodic, so the whole frame is scaled
+            self.source = (slice(None), slice(None))
+            self.crop = (slice(*rows), slice(*columns))
+        self.interpolation = cv.INTER_AREA if self.factor < 1 else cv.INTER_LINEAR
+        self.buffer = None
+
+    def __call__(self, frame: Frame) -> Frame:
+        image = frame.image[self.source]
+        if self.factor != 1:
+            self.buffer = cv.resize(image, None, self.buffer, self.factor, self.factor, self.interpolation)
+            image = self.buffer
+        return frame.with_image(img.grayscale(image[self.crop]))
+
+
+def preprocess_frames(frames: Iterable[Frame], config: Config) -> Generator[Frame, None, None]:
+    """
+    Preprocesses the frames of a single video (see `Preprocessor`).
+    """
+    preprocessor = None
+    for frame in frames:
+        preprocessor = preprocessor or Preprocessor(frame.image.shape, config)
+        yield preprocessor(frame)
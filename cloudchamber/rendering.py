@@ -0,0 +1,175 @@
+import os
+import math
+import cv2 as cv
+import numpy as np
+from pathlib import Path
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, List, Sequence, Tuple
+
+from bettercv.image import abc
+from bettercv.types import Image
+from bettercv.video import Video
+from bettercv.contours import draw_contours
+
+from .config import Config
+from .particle import Particle
+from .processing import Preprocessor
+
+TILE_SIZE = 200  # The side of each particle's tile in a contact sheet, in px
+SHEET_COLUMNS = 6
+SHEET_ROWS = 5
+SHEET_SIZE = SHEET_COLUMNS * SHEET_ROWS
+PADDING = 20  # Pixels shown around each particle's bounding box
+CLIP_SIZE = 400  # The side of the clips, in px
+CLIP_MARGIN = 10  # Frames shown before and after each particle's track
+CONTOUR_COLOR = (0, 0, 255)
+TEXT_COLOR = (255, 255, 255)
+
+
+def _region(particle: Particle, shape: Tuple[int, ...], padding: int) -> Tuple[slice, slice]:
+    """
+    A square region around the particle's contour (clipped to the frame), as (rows, columns).
+    """
+    x, y, width, height = particle.snapshot.contour.bounding_rect
+    half = max(width, height) // 2 + padding
+    center_x, center_y = x + width // 2, y + height // 2
+    return (slice(max(center_y - half, 0), min(center_y + half, shape[0])),
+            slice(max(center_x - half, 0), min(center_x + half, shape[1])))
+
+
+def _fit(image: Image, size: int) -> Image:
+    """
+    Scales the image to fit in a black square of the given size, keeping its aspect ratio.
+    """
+    factor = size / max(image.shape[:2])
+    scaled = cv.resize(image, (max(round(image.shape[1] * factor), 1), max(round(image.shape[0] * factor), 1)),
+                       interpolation=cv.INTER_AREA if factor < 1 else cv.INTER_LINEAR)
+    canvas = np.zeros((size, size, 3), np.uint8)
+    top, left = (size - scaled.shape[0]) // 2, (size - scaled.shape[1]) // 2
+    canvas[top:top + scaled.shape[0], left:left + scaled.shape[1]] = scaled
+    return canvas
+
+
+def _label(image: Image, text: str) -> Image:
+    cv.putText(image, text, (4, image.shape[0] - 6), cv.FONT_HERSHEY_SIMPLEX, 0.4, TEXT_COLOR, 1, cv.LINE_AA)
+    return image
+
+
+def _tile(image: Image, particle: Particle) -> Image:
+    annotated = draw_contours(image, [particle.snapshot.contour], CONTOUR_COLOR, thickness=1)
+    rows, columns = _region(particle, image.shape, PADDING)
+    return _label(_fit(annotated[rows, columns], TILE_SIZE),
+                  f"#{particle.snapshot.ref.index} L{particle.length:.0f} W{particle.width:.0f}")
+
+
+def _save_sheet(tiles: List[Image], path: Path) -> Path:
+    tiles = tiles + [np.zeros_like(tiles[0])] * (SHEET_SIZE - len(tiles))
+    rows = [np.hstack(tiles[start:start + SHEET_COLUMNS]) for start in range(0, len(tiles), SHEET_COLUMNS)]
+    cv.imwrite(str(path), np.vstack(rows))
+    return path
+
+
+def _clip_range(particle: Particle, frame_num: int) -> range:
+    return range(max(particle.start.index - CLIP_MARGIN, 0), min(particle.end.index + CLIP_MARGIN + 1, frame_num))
+
+
+def _split_particles(particles: Sequence[Particle], parts: int) -> List[Tuple[int, List[Particle]]]:
+    """
+    Splits the particles of a video into up to the given number of parts, each a contiguous range of frames
+    with whole sheets of particles.
+
+    Returns:
+        Pairs of the number of the first sheet of each part, and its particles
+    """
+    particles = sorted(particles, key=lambda particle: particle.snapshot.ref.index)
+    size = math.ceil(len(particles) / SHEET_SIZE / parts) * SHEET_SIZE
+    return [(start // SHEET_SIZE, particles[start:start + size]) for start in range(0, len(particles), size)]
+
+
+def render_video(path: Path, particles: Sequence[Particle], output: Path,
+                 clips: bool = False, config: Config = None, first_sheet: int = 0) -> List[Path]:
+    """
+    Renders the particles of a single video without any GUI, in one sequential pass over the video:
+    a contact sheet PNG of the particles' snapshots, or an annotated MP4 clip of each particle's track.
+    Each frame is decoded and preprocessed once, for all the particles which need it.
+    The sheets are numbered from `first_sheet`, so the particles of a video can be rendered in parts.
+
+    Returns:
+        The paths of the written files
+    """
+    config = config or Config()
+    particles = sorted(particles, key=lambda particle: particle.snapshot.ref.index)
+    written = []
+    with Video(path) as video:
+        # The particles which need each frame
+        needed: Dict[int, List[Particle]] = defaultdict(list)
+        for particle in particles:
+            for index in _clip_range(particle, video.frame_num) if clips else [particle.snapshot.ref.index]:
+                needed[index].append(particle)
+        preprocessor = None
+        tiles: List[Image] = []
+        writers: Dict[int, cv.VideoWriter] = {}
+        try:
+            for frame in video.iter_frames_at(sorted(needed)):
+                if preprocessor is None:
+                    preprocessor = Preprocessor(frame.image.shape, config)
+                image = abc(preprocessor(frame).image)
+                for particle in needed.pop(frame.ref.index):
+                    if not clips:
+                        tiles.append(_tile(image, particle))
+                        if len(tiles) == SHEET_SIZE:
+                            sheet = first_sheet + len(written)
+                            written.append(_save_sheet(tiles, output / f"{path.stem}-{sheet:03}.png"))
+                            tiles = []
+                        continue
+                    key = id(particle)
+                    if key not in writers:
+                        clip_path = output / f"{path.stem}-{particle.start.index}-{particle.snapshot.ref.index}.mp4"
+                        writers[key] = cv.VideoWriter(str(clip_path), cv.VideoWriter_fourcc(*"mp4v"),
+                                                      video.fps, (CLIP_SIZE, CLIP_SIZE))
+                        written.append(clip_path)
+                    rows, columns = _region(particle, image.shape, 4 * PADDING)
+                    annotated = draw_contours(image, [particle.snapshot.contour], CONTOUR_COLOR, thickness=1)
+                    writers[key].write(_label(_fit(annotated[rows, columns], CLIP_SIZE), f"#{frame.ref.index}"))
+                    if frame.ref.index == _clip_range(particle, video.frame_num)[-1]:
+                        writers.pop(key).release()
+        finally:
+            for writer in writers.values():
+                writer.release()
+        if tiles:
+            written.append(_save_sheet(tiles, output / f"{path.stem}-{first_sheet + len(written):03}.png"))
+    return written
+
+
+def render_particles(particles: Sequence[Particle], output: Path, clips: bool = False,
+                     workers: int = None, config: Config = None) -> List[Path]:
+    """
+    Renders the particles (see `render_video`) in worker processes.
+    The particles of each video are split into contiguous parts (see `_split_particles`), one for each worker,
+    and each part is rendered in its own pass over its range of the video.
+
+    Returns:
+        The paths of the written files
+    """
+    output.mkdir(parents=True, exist_ok=True)
+    workers = workers or os.cpu_count()
+    by_video: Dict[str, List[Particle]] = defaultdict(list)
+    for particle in particles:
+        by_video[particle.snapshot.ref.video].append(particle)
+    written = []
+    with ProcessPoolExecutor(workers) as executor:
+        futures = {executor.submit(render_video, Path(video), part, output, clips, config, first_sheet):
+                   (video, part) for video, video_particles in by_video.items()
+                   for first_sheet, part in _split_particles(video_particles, workers)}
+        for future in as_completed(futures):
+            video, part = futures[future]
+            try:
+                paths = future.result()
+                written.extend(paths)
+                status = f"wrote {len(paths)} files"
+            except Exception as error:
+                # One broken video should not stop the others from rendering
+                status = f"failed ({error!r})"
+            print(f"{Path(video).name} [{part[0].snapshot.ref.index}-{part[-1].snapshot.ref.index}]: {status}")
+    return written
@@ -0,0 +1,137 @@
+import pandas as pd
+from pathlib import Path
+from queue import Queue
+from threading import Thread
+from itertools import product
+from time import thread_time
+from dataclasses import dataclass, field, fields, asdict
+from typing import Any, Dict, Generator, Iterable, List, Sequence
+
+from bettercv.video import Video
+
+from .particle import Particle
+from .config import Config, PREPROCESSING_FIELDS
+from .detection import prepare, subtract_prepared, detect_binaries, track_detections, to_particles
+
+# How many frames each pipeline may lag behind the decoding
+QUEUE_SIZE = 64
+_END = object()
+
+
+def config_grid(base: Dict[str, Any] = None, **values: Sequence) -> List[Config]:
+    """
+    Creates a config for each combination of the given values.
+
+    Example:
+        ```
+        config_grid({"bg_method": "avg"}, dist_close=[20, 30], track_distance=[20, 30, 40])  # 6 configs
+        ```
+    """
+    return [Config.merge({**(base or {}), **dict(zip(values, combination))})
+            for combination in product(*values.values())]
+
+
+def _drain(channel: Queue) -> Generator[Any, None, None]:
+    while (item := channel.get()) is not _END:
+        yield item
+
+
+def _fan_out(items: Iterable, channels: Sequence[Queue]) -> None:
+    try:
+        for item in items:
+            for channel in channels:
+                channel.put(item)
+    finally:
+        for channel in channels:
+            channel.put(_END)
+
+
+@dataclass
+class SweepResult:
+    config: Config
+    particles: List[Particle] = field(default_factory=list)
+    cpu_seconds: float = 0
+    error: Exception = None
+
+
+class _Pipeline(Thread):
+    """
+    Detects particles in the prepared frames it receives, using a single config.
+    """
+
+    def __init__(self, config: Config) -> None:
+        super().__init__(daemon=True)
+        self.channel = Queue(QUEUE_SIZE)
+        self.result = SweepResult(config)
+
+    def run(self) -> None:
+        config = self.result.config
+        prepared = _drain(self.channel)
+        try:
+            binaries = subtract_prepared(prepared, config)
+            self.result.particles = list(to_particles(track_detections(detect_binaries(binaries, config), config),
+                                                      config))
+        except Exception as error:
+            self.result.error = error
+            # Keep consuming, so the other pipelines aren't blocked by this one
+            for _ in prepared:
+                pass
+        self.result.cpu_seconds = thread_time()
+
+
+class _Preparation(Thread):
+    """
+    Preprocesses the decoded frames once, for all the pipelines sharing the same preprocessing fields.
+    """
+
+    def __init__(self, pipelines: Sequence[_Pipeline]) -> None:
+        super().__init__(daemon=True)
+        self.channel = Queue(QUEUE_SIZE)
+        self.pipelines = pipelines
+
+    def run(self) -> None:
+        frames = _drain(self.channel)
+        channels = [pipeline.channel for pipeline in self.pipelines]
+        try:
+            _fan_out(prepare(frames, self.pipelines[0].result.config), channels)
+        except Exception as error:
+            for pipeline in self.pipelines:
+                pipeline.result.error = error
+            # Keep consuming, so the other preparations aren't blocked by this one
+            for _ in frames:
+                pass
+
+
+def sweep(path: Path, configs: Sequence[Config], start: int = 0, stop: int = None) -> List[SweepResult]:
+    """
+    Runs detection on a video (between the given times, in seconds) with each of the given configs,
+    decoding the video only once.
+    Configs with the same preprocessing fields also share the preprocessed frames.
+    Each config runs in its own thread, and OpenCV releases the GIL, so they also run in parallel.
+    """
+    pipelines = [_Pipeline(config) for config in configs]
+    groups: Dict[str, List[_Pipeline]] = {}
+    for pipeline in pipelines:
+        groups.setdefault(pipeline.result.config.digest(PREPROCESSING_FIELDS), []).append(pipeline)
+    preparations = [_Preparation(group) for group in groups.values()]
+    for thread in [*preparations, *pipelines]:
+        thread.start()
+    with Video(path) as video:
+        _fan_out(video.iter_frames(start=video.index_at(start), stop=video.index_at(stop) if stop else None),
+                 [preparation.channel for preparation in preparations])
+    for thread in [*preparations, *pipelines]:
+        thread.join()
+    return [pipeline.result for pipeline in pipelines]
+
+
+def summarize(results: Sequence[SweepResult]) -> pd.DataFrame:
+    """
+    A table of the results, with the config fields which vary between them.
+    """
+    table = pd.DataFrame([asdict(result.config) for result in results])
+    varying = [column.name for column in fields(Config) if table[column.name].astype(str).nunique() > 1]
+    table = table[varying]
+    table["particles"] = [len(result.particles) for result in results]
+    table["cpu_seconds"] = [result.cpu_seconds for result in results]
+    table["error"] = [repr(result.error) if result.error else "" for result in results]
+    return table
@@ -0,0 +1,77 @@
+import numpy as np
+from typing import List, Sequence
+
+from bettercv.track import Track
+from bettercv.video import Frame
+from bettercv.contours import Contour
+
+from .features import measure_features
+from .particle import snapshot_score
+
+
+def _centroids(contours: Sequence[Contour]) -> np.ndarray:
+    return np.array([contour.centroid for contour in contours], dtype=float).reshape(-1, 2)
+
+
+class Tracker:
+    """
+    Associates the contours of each frame with the tracks of the previous frames.
+
+    A track can only be continued on the frame right after its end, so tracks that missed a frame are
+    retired from the active set (and handed back to the caller), and each frame is only matched against
+    the active tracks.
+
+    The tracks only keep what their particles need (see `Track`), unless `keep_history` is set.
+    """
+
+    def __init__(self, track_distance: int, active: List[Track] = None, keep_history: bool = False) -> None:
+        self.track_distance = track_distance
+        self.active: List[Track] = active or []
+        self.keep_history = keep_history
+
+    def retire(self, index: int) -> List[Track]:
+        """
+        Removes the tracks that can no longer be continued on the frame at the given index.
+
+        Returns:
+            The retired tracks
+        """
+        retired = [track for track in self.active if index - track.end.ref.index > 1]
+        if retired:
+            self.active = [track for track in self.active if index - track.end.ref.index <= 1]
+        return retired
+
+    def flush(self) -> List[Track]:
+        """
+        Retires all the active tracks (e.g. at the end of the video).
+        """
+        retired, self.active = self.active, []
+        return retired
+
+    def update(self, contours: Sequence[Contour], frame: Frame) -> List[Track]:
+        """
+        Records the contours of a frame, each on the single active track whose end is close to it,
+        or on a new track if there is no such track or more than one.
+        A track is continued at most once per frame.
+        The features of the contours are measured on the frame's image, if it has one.
+
+        Returns:
+            The tracks retired before this frame
+        """
+        retired = self.retire(frame.ref.index)
+        offsets = _centroids(contours)[:, np.newaxis] - _centroids([track.end.contour for track in self.active])
+        close = (offsets ** 2).sum(axis=-1) < self.track_distance ** 2
+        available = np.ones(len(self.active), dtype=bool)
+        new_tracks = []
+        for contour, candidates in zip(contours, close):
+            features = measure_features(contour, frame.image) if frame.image is not None else None
+            matches = np.flatnonzero(candidates & available)
+            if len(matches) == 1:
+                self.active[matches[0]].record(contour, frame, features)
+                available[matches[0]] = False
+            else:
+                track = Track(snapshot_score, self.keep_history)
+                track.record(contour, frame, features)
+                new_tracks.append(track)
+        self.active.extend(new_tracks)
+        return retired
@@ -1,15 +1,21 @@
+import os
+import csv
 import json
+import shutil
 import numpy as np
 import pandas as pd
 from pathlib import Path
 from collections import namedtuple
-from typing import List, Tuple, Iterable
+from dataclasses import asdict
+from typing import List, Tuple, Iterable, Iterator, Dict, Sequence, Union
 
 from bettercv.video import Ref
 from bettercv.track import Snapshot
 from bettercv.contours import Contour
 
-from cloudchamber.particle import Particle
+from cloudchamber.config import Config
+from cloudchamber.particle import Particle, ParticleTable
+from cloudchamber.features import FEATURES, backfill_features
 
 from root import ROOT_PATH
 
@@ -17,11 +23,34 @@ BG_RADIATION_PATH = ROOT_PATH / "Background"
 ROD_RADIATION_PATH = ROOT_PATH / "Rod"
 
 CSV_PATH = ROOT_PATH / "csv"
+CACHE_PATH = ROOT_PATH / "cache"
 GRAPH_PATH = ROOT_PATH / "graphs"
 
+# How many particles missing their features a `ParticleWriter` holds, to backfill them in one pass over the video
+BACKFILL_BATCH = 200
+
 _COLUMNS = ("Width", "Length", "Angle", "Curvature", "Intensity", "Type",
             "StartIndex", "StartTime", "EndIndex", "EndTime",
             "SnapshotIndex", "SnapshotTime", "Video", "Contour")
+_SCALAR_COLUMNS = {"Width": np.float64, "Length": np.float64, "Angle": np.float64, "Curvature": np.float64,
+                   "Intensity": np.float64, "Type": np.int64,
+                   "StartIndex": np.int64, "StartTime": np.float64, "EndIndex": np.int64, "EndTime": np.float64,
+                   "SnapshotIndex": np.int64, "SnapshotTime": np.float64}
+_Row = namedtuple("Row", _COLUMNS)
+# The scalar columns which are in a `ParticleTable` (besides the constant type)
+_TABLE_COLUMNS = {"Width": "width", "Length": "length", "Angle": "angle", "Curvature": "curvature",
+                  "Intensity": "intensity", "StartIndex": "start_index", "StartTime": "start_time",
+                  "EndIndex": "end_index", "EndTime": "end_time",
+                  "SnapshotIndex": "snapshot_index", "SnapshotTime": "snapshot_time"}
+
+# Rows read at a time when streaming columns (see `iter_columns`)
+CHUNK_SIZE = 100_000
+
+# The columnar format is a directory with the scalar columns, and all the contour points in one flat array
+COLUMNAR_SUFFIX = ".particles"
+_COLUMNS_FILE = "columns.npz"
+_POINTS_FILE = "points.npy"
+_OFFSETS_FILE = "offsets.npy"
 
 
 def _is_video(path: Path) -> bool:
@@ -56,23 +85,260 @@ def _serialize_ref(ref: Ref) -> Tuple[int, float]:
     return ref.index, ref.timestamp
 
 
-def _serialize_particle(particle: Particle) -> Tuple:
+def _serialize_scalars(particle: Particle) -> Tuple:
     return (particle.width, particle.length, particle.angle, particle.curvature, particle.intensity, 0,
             *_serialize_ref(particle.start), *_serialize_ref(particle.end),
-            *_serialize_ref(particle.snapshot.ref), particle.snapshot.ref.video,
+            *_serialize_ref(particle.snapshot.ref))
+
+
+def _serialize_particle(particle: Particle) -> Tuple:
+    return (*_serialize_scalars(particle), particle.snapshot.ref.video,
             _serialize_contour(particle.snapshot.contour))
 
 
-def _parse_particle(row: namedtuple) -> Particle:
+def _parse_features(row: namedtuple) -> Dict[str, float]:
+    return {} if pd.isna(row.Intensity) else {"intensity": row.Intensity}
+
+
+def _parse_particle(row: namedtuple, contour: Contour) -> Particle:
     return Particle((Ref(row.Video, row.StartIndex, row.StartTime), Ref(row.Video, row.EndIndex, row.EndTime)),
                     Snapshot(Ref(row.Video, row.SnapshotIndex, row.SnapshotTime), row.SnapshotIndex - row.StartIndex,
-                             _parse_contour(row.Contour)))
+                             contour, _parse_features(row)))
+
+
+class ParticleStore(Sequence[Particle]):
+    """
+    Particles loaded from the columnar format.
+
+    The scalar columns are available as arrays in `columns` without building any particle,
+    the contour points are memory-mapped, and each particle is only built when it is first accessed.
+    """
+
+    def __init__(self, path: Path) -> None:
+        with np.load(path / _COLUMNS_FILE) as columns:
+            self.columns: Dict[str, np.ndarray] = {name: columns[name] for name in columns.files}
+        self.points = np.load(path / _POINTS_FILE, mmap_mode="r")
+        self.offsets = np.load(path / _OFFSETS_FILE)
+        self._particles: Dict[int, Particle] = {}
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index: Union[int, slice]) -> Union[Particle, List[Particle]]:
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("Particle index out of range")
+        if index not in self._particles:
+            self._particles[index] = self._build(index)
+        return self._particles[index]
+
+    def contour(self, index: int) -> Contour:
+        points = self.points[self.offsets[index]:self.offsets[index + 1]]
+        return Contour(np.array(points, dtype=np.int32).reshape(-1, 1, 2))
+
+    def table(self) -> ParticleTable:
+        """
+        A table of the particles, from the stored columns (so no particle is built until it is accessed).
+        """
+        return _table_from_columns(self, self.columns)
+
+    def _build(self, index: int) -> Particle:
+        row = _Row(**{name: self.columns[name][index].item() for name in _SCALAR_COLUMNS},
+                   Video=str(self.columns["videos"][self.columns["Video"][index]]), Contour=None)
+        return _parse_particle(row, self.contour(index))
+
+
+def _is_columnar(path: Path) -> bool:
+    return path.suffix.lower() == COLUMNAR_SUFFIX
+
+
+def _table_from_columns(particles: Sequence[Particle], columns: Dict[str, Sequence]) -> ParticleTable:
+    return ParticleTable(particles, {column: np.asarray(columns[name], dtype=_SCALAR_COLUMNS[name])
+                                     for name, column in _TABLE_COLUMNS.items()})
+
+
+def _scalar_columns(table: ParticleTable) -> Dict[str, np.ndarray]:
+    return {name: table[_TABLE_COLUMNS[name]] if name in _TABLE_COLUMNS else np.zeros(len(table), dtype=dtype)
+            for name, dtype in _SCALAR_COLUMNS.items()}
+
+
+def _write_csv(particles: List[Particle], path: Path) -> None:
+    columns = _scalar_columns(ParticleTable.from_particles(particles))
+    columns["Video"] = [particle.snapshot.ref.video for particle in particles]
+    columns["Contour"] = [_serialize_contour(particle.snapshot.contour) for particle in particles]
+    pd.DataFrame(columns, columns=_COLUMNS).to_csv(path, index=False)
+
+
+def _write_columnar(particles: List[Particle], path: Path) -> None:
+    columns = _scalar_columns(ParticleTable.from_particles(particles))
+    videos, codes = np.unique([str(particle.snapshot.ref.video) for particle in particles], return_inverse=True)
+    points = [particle.snapshot.contour.points.reshape(-1, 2) for particle in particles]
+    path.mkdir()
+    np.savez(path / _COLUMNS_FILE, **columns, Video=codes.astype(np.int32), videos=videos.astype(str))
+    np.save(path / _POINTS_FILE, np.concatenate(points).astype(np.int32) if points else np.empty((0, 2), np.int32))
+    np.save(path / _OFFSETS_FILE, np.cumsum([0] + [len(contour) for contour in points], dtype=np.int64))
+
+
+def _config_path(path: Path) -> Path:
+    # The full name is kept, so the same particles in different formats (foo.csv, foo.particles) have their own configs
+    return path.with_name(path.name + ".json")
+
+
+def save_config(config: Config, path: Path) -> None:
+    _config_path(path).write_text(json.dumps({"digest": config.digest(), "config": asdict(config)}, indent=2))
+
+
+def has_particles(path: Path, config: Config) -> bool:
+    """
+    Checks whether the particles at the given path were already detected using the given config.
+    """
+    config_path = _config_path(path)
+    return (path.exists() and config_path.exists()
+            and json.loads(config_path.read_text())["digest"] == config.digest())
+
+
+def save_particles(particles: Iterable[Particle], path: Path, config: Config = None) -> None:
+    particles = list(particles)
+    backfill_features((particle.snapshot for particle in particles), config)
+    # Write to a temporary file first, so that an interrupted run never leaves a partial file behind
+    temp_path = path.with_name(f".{path.name}.tmp")
+    if _is_columnar(path):
+        shutil.rmtree(temp_path, ignore_errors=True)
+        _write_columnar(particles, temp_path)
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        _write_csv(particles, temp_path)
+    os.replace(temp_path, path)
+    if config:
+        save_config(config, path)
+
+
+class ParticleWriter:
+    """
+    Writes particles to a file one at a time, as soon as they are found.
+    Can be used as a context manager.
+
+    CSV rows are flushed as they are written, so a crashed run keeps the particles found until the crash.
+    Particles missing their features (e.g. replayed from a cache, without images) are held until a batch of them
+    can be backfilled in one pass over the video, instead of one seek per particle.
+    The columnar format can't be appended to, so its particles are kept until the writer is closed,
+    and are only written if the run completed.
+    The config is only saved once a completed run is closed, so an incomplete file is never mistaken for a finished one.
+    """
+
+    def __init__(self, path: Path, config: Config = None) -> None:
+        self.path = path
+        self.config = config
+        self.count = 0
+        self._particles: List[Particle] = []
+        # The particles waiting for their features to be backfilled (and the ones after them, to keep the order)
+        self._pending: List[Particle] = []
+        self._missing = 0
+        self._file = None
+        self._writer = None
+
+    def __enter__(self) -> "ParticleWriter":
+        return self.open()
+
+    def __exit__(self, exc_type, *exc_args) -> bool:
+        # A run which raised (or was interrupted) is incomplete
+        self.close(complete=exc_type is None)
+        return False
+
+    def open(self) -> "ParticleWriter":
+        _config_path(self.path).unlink(missing_ok=True)
+        if not _is_columnar(self.path):
+            self._file = open(self.path, "w", newline="")
+            self._writer = csv.writer(self._file)
+            self._writer.writerow(_COLUMNS)
+        return self
+
+    def write(self, particle: Particle) -> None:
+        self._pending.append(particle)
+        self._missing += bool(set(FEATURES) - set(particle.snapshot.features))
+        if not self._missing or self._missing >= BACKFILL_BATCH:
+            self._flush()
+        self.count += 1
+
+    def _flush(self) -> None:
+        backfill_features([particle.snapshot for particle in self._pending], self.config)
+        if self._writer:
+            self._writer.writerows(map(_serialize_particle, self._pending))
+            self._file.flush()
+        else:
+            self._particles.extend(self._pending)
+        self._pending, self._missing = [], 0
+
+    def close(self, complete: bool = True) -> None:
+        """
+        Closes the file, and marks it as finished (by saving the config) if the run is complete.
+        """
+        self._flush()
+        if self._file:
+            self._file.close()
+            if complete and self.config:
+                save_config(self.config, self.path)
+        elif complete:
+            save_particles(self._particles, self.path, self.config)
+
+
+def load_particles(path: Path) -> Sequence[Particle]:
+    """
+    Loads particles from a CSV file, or from a directory in the columnar format (by its suffix).
+    """
+    path = Path(path)
+    if _is_columnar(path):
+        return ParticleStore(path)
+    return [_parse_particle(row, _parse_contour(row.Contour)) for row in pd.read_csv(path).itertuples()]
+
+
+def load_table(path: Path) -> ParticleTable:
+    """
+    Loads particles like `load_particles`, with a table of their features from the stored columns
+    (instead of computing them again from the contours).
+    """
+    path = Path(path)
+    if _is_columnar(path):
+        return ParticleStore(path).table()
+    frame = pd.read_csv(path)
+    return _table_from_columns([_parse_particle(row, _parse_contour(row.Contour)) for row in frame.itertuples()],
+                               frame)
+
+
+def iter_columns(path: Path, columns: Sequence[str], chunk_size: int = CHUNK_SIZE) -> Iterator[Dict[str, np.ndarray]]:
+    """
+    Streams scalar columns of stored particles in chunks of rows, without parsing any contour or building particles.
 
+    Args:
+        path: A CSV file, or a directory in the columnar format
+        columns: The names of the columns, as in a `ParticleTable` (e.g. "length")
+        chunk_size: The number of rows in each chunk
 
-def save_particles(particles: Iterable[Particle], path: Path) -> None:
-    data = pd.DataFrame(map(_serialize_particle, particles), columns=_COLUMNS)
-    data.to_csv(path, index=False)
+    Returns:
+        A generator of chunks, each with an array for each of the columns and a "video" array
+    """
+    names = {column: name for name, column in _TABLE_COLUMNS.items()}
+    path = Path(path)
+    if _is_columnar(path):
+        # Arrays in an .npz can't be memory-mapped, so only the needed columns are read (whole)
+        with np.load(path / _COLUMNS_FILE) as stored:
+            arrays = {column: stored[names[column]] for column in columns}
+            codes, videos = stored["Video"], stored["videos"]
+        for start in range(0, len(codes), chunk_size):
+            yield {"video": videos[codes[start:start + chunk_size]],
+                   **{column: array[start:start + chunk_size] for column, array in arrays.items()}}
+        return
+    for frame in pd.read_csv(path, usecols=[names[column] for column in columns] + ["Video"], chunksize=chunk_size):
+        yield {"video": frame["Video"].to_numpy(str), **{column: frame[names[column]].to_numpy() for column in columns}}
 
 
-def load_particles(path: Path) -> List[Particle]:
-    return [_parse_particle(row) for row in pd.read_csv(path).itertuples()]
+def convert_particles(source: Path, destination: Path) -> None:
+    """
+    Converts particles between formats (e.g. an existing CSV to the columnar format), keeping their config.
+    """
+    save_particles(load_particles(source), destination)
+    if _config_path(source).exists():
+        shutil.copyfile(_config_path(source), _config_path(destination))
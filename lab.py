@@ -1,19 +1,86 @@
+import json
 from time import time
 import argparse as ap
 from pathlib import Path
+from dataclasses import asdict
 
-from cloudchamber.detection import analyze_video
+from cloudchamber.config import Config
+from cloudchamber.cache import ContourCache
+from bettercv.video import Video
+from bettercv.profiling import Profiler, profiling
+
+from cloudchamber.detection import analyze_video, stream_video, compare_join_methods
+from cloudchamber.parallel import analyze_video_parallel
+from cloudchamber.sweep import sweep, config_grid, summarize
 from cloudchamber.debugging import display_particles
+from cloudchamber.rendering import render_particles
 
-from analysis import plot_histograms
-from fs import save_particles, load_particles, CSV_PATH, GRAPH_PATH
+from analysis import plot_histograms, aggregate_histograms, plot_aggregated_histograms
+from batch import Job, detect_all, all_videos, load_manifest
+from fs import (save_particles, load_particles, load_table, convert_particles, ParticleWriter,
+                CSV_PATH, GRAPH_PATH, CACHE_PATH, COLUMNAR_SUFFIX)
 
 
-def detect(path: Path, start: int, duration: int) -> None:
+def _detect(path: Path, start: int, duration: int, segments: int = None,
+            stream: bool = False, resumable: bool = False, cached: bool = False) -> None:
+    config = Config()
     start_time = time()
-    particles = analyze_video(path, start, (start + duration) if duration else None)
+    stop = (start + duration) if duration else None
+    # Named like a batch job, so a partial range is never mistaken for the whole video
+    csv_path = Job(path, start, duration).csv_path
+    checkpoint = csv_path.with_suffix(".checkpoint") if resumable else None
+    cache = ContourCache(CACHE_PATH) if cached else None
+    if stream:
+        with ParticleWriter(csv_path, config) as writer:
+            for particle in stream_video(path, start, stop, checkpoint, cache, **asdict(config)):
+                writer.write(particle)
+        print(f"Found {writer.count} particles in {time() - start_time} seconds")
+        return
+    if segments:
+        particles = analyze_video_parallel(path, start, stop, segments, **asdict(config))
+    else:
+        particles = analyze_video(path, start, stop, checkpoint, cache, **asdict(config))
     print(f"Found {len(particles)} particles in {time() - start_time} seconds")
-    save_particles(particles, CSV_PATH / path.with_suffix(".csv").name)
+    save_particles(particles, csv_path, config)
+
+
+def detect(path: Path, start: int, duration: int, segments: int = None, stream: bool = False,
+           resumable: bool = False, cached: bool = False, profile: bool = False, trace: Path = None) -> None:
+    if not (profile or trace):
+        return _detect(path, start, duration, segments, stream, resumable, cached)
+    with profiling(Profiler(trace=bool(trace))) as profiler:
+        _detect(path, start, duration, segments, stream, resumable, cached)
+    print(profiler.summary())
+    if trace:
+        profiler.save_trace(trace)
+
+
+def compare_join(path: Path, start: int, duration: int) -> None:
+    with Video(path) as video:
+        stop = video.index_at(start + duration) if duration else None
+        print(compare_join_methods(video.iter_frames(start=video.index_at(start), stop=stop)))
+
+
+def sweep_configs(path: Path, start: int, duration: int, grid_path: Path) -> None:
+    """
+    Runs detection with each combination of the values in the grid file, a JSON of the form
+    `{"base": {field: value, ...}, "grid": {field: [value, ...], ...}}`.
+    """
+    with open(grid_path) as file:
+        grid = json.load(file)
+    configs = config_grid({"prints": False, **grid.get("base", {})}, **grid["grid"])
+    start_time = time()
+    results = sweep(path, configs, start, (start + duration) if duration else None)
+    print(f"Ran {len(configs)} configs in {time() - start_time} seconds")
+    sweep_path = CSV_PATH / "sweep"
+    sweep_path.mkdir(parents=True, exist_ok=True)
+    for result in results:
+        if not result.error:
+            save_particles(result.particles, sweep_path / f"{path.stem}-{result.config.digest()}.csv", result.config)
+    summary = summarize(results)
+    summary["digest"] = [result.config.digest() for result in results]
+    print(summary.to_string())
+    summary.to_csv(sweep_path / f"{path.stem}-{grid_path.stem}.csv", index=False)
 
 
 def parse_args() -> ap.Namespace:
@@ -24,25 +91,82 @@ def parse_args() -> ap.Namespace:
     detect_parser.add_argument("video", type=Path)
     detect_parser.add_argument("start", type=int, default=0)
     detect_parser.add_argument("duration", type=int, nargs="?")
+    detect_mode = detect_parser.add_mutually_exclusive_group()
+    detect_mode.add_argument("--segments", type=int, help="Split the video into segments tracked in parallel")
+    detect_mode.add_argument("--stream", action="store_true", help="Write each particle as soon as it is found")
+    detect_reuse = detect_parser.add_mutually_exclusive_group()
+    detect_reuse.add_argument("--resumable", action="store_true",
+                              help="Save periodic checkpoints, and resume from the last one if there is one")
+    detect_reuse.add_argument("--cache", action="store_true",
+                              help="Replay the detected contours of a previous run with the same preprocessing")
+    detect_parser.add_argument("--profile", action="store_true",
+                               help="Print the time spent in each stage (of the main process only, with --segments)")
+    detect_parser.add_argument("--trace", type=Path, help="Also save a Chrome trace of the stages (implies --profile)")
+    # Batch detection options
+    detect_all_parser = subparsers.add_parser("detect-all")
+    detect_all_parser.add_argument("--manifest", type=Path, help="A CSV of `video,start,duration` segments")
+    detect_all_parser.add_argument("--workers", type=int, help="The number of worker processes (default: all cores)")
+    # Join methods comparison options
+    compare_join_parser = subparsers.add_parser("compare-join")
+    compare_join_parser.add_argument("video", type=Path)
+    compare_join_parser.add_argument("start", type=int, default=0)
+    compare_join_parser.add_argument("duration", type=int, nargs="?")
+    # Parameter sweep options
+    sweep_parser = subparsers.add_parser("sweep")
+    sweep_parser.add_argument("video", type=Path)
+    sweep_parser.add_argument("start", type=int, default=0)
+    sweep_parser.add_argument("duration", type=int, nargs="?")
+    sweep_parser.add_argument("--grid", type=Path, required=True,
+                              help="A JSON of the config values to sweep (see `sweep_configs`)")
+    # Conversion options
+    convert_parser = subparsers.add_parser("convert")
+    convert_parser.add_argument("source", type=Path)
+    convert_parser.add_argument("destination", type=Path, nargs="?",
+                                help=f"Defaults to the source with a {COLUMNAR_SUFFIX} suffix")
     # Display options
     display_parser = subparsers.add_parser("display")
     display_parser.add_argument("csv", type=Path)
+    render_parser = subparsers.add_parser("render", help="Render the particles of a CSV to files, without a GUI")
+    render_parser.add_argument("csv", type=Path)
+    render_parser.add_argument("--clips", action="store_true",
+                               help="Write an annotated clip of each particle's track instead of contact sheets")
+    render_parser.add_argument("--output", type=Path, help="The output directory (default: under the graphs)")
+    render_parser.add_argument("--workers", type=int, help="The number of worker processes (default: all cores)")
     # Histogram options
     hist_parser = subparsers.add_parser("hist")
     hist_parser.add_argument("csv", type=Path)
+    hist_all_parser = subparsers.add_parser("hist-all", help="Plot histograms of all the CSVs, split by video source")
+    hist_all_parser.add_argument("--workers", type=int, help="The number of worker processes (default: all cores)")
 
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.action == "detect" and args.segments and (args.resumable or args.cache):
+        detect_parser.error("argument --segments: not allowed with argument --resumable or --cache")
+    return args
 
 
 def main() -> None:
     args = parse_args()
     match args.action:
         case "detect":
-            detect(args.video, args.start, args.duration)
+            detect(args.video, args.start, args.duration, args.segments, args.stream, args.resumable,
+                   args.cache, args.profile, args.trace)
+        case "detect-all":
+            detect_all(load_manifest(args.manifest) if args.manifest else all_videos(), args.workers, prints=False)
+        case "compare-join":
+            compare_join(args.video, args.start, args.duration)
+        case "sweep":
+            sweep_configs(args.video, args.start, args.duration, args.grid)
+        case "convert":
+            convert_particles(args.source, args.destination or args.source.with_suffix(COLUMNAR_SUFFIX))
         case "display":
             display_particles(load_particles(args.csv))
+        case "render":
+            render_particles(load_particles(args.csv), args.output or GRAPH_PATH / args.csv.stem,
+                             args.clips, args.workers)
         case "hist":
-            plot_histograms(load_particles(args.csv), save_dir=GRAPH_PATH, show=False)
+            plot_histograms(load_table(args.csv), save_dir=GRAPH_PATH, show=False)
+        case "hist-all":
+            plot_aggregated_histograms(aggregate_histograms(workers=args.workers), save_dir=GRAPH_PATH, show=False)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,138 @@
+import json
+import cv2 as cv
+import numpy as np
+import argparse as ap
+from pathlib import Path
+from dataclasses import dataclass, asdict
+from typing import List, Tuple
+
+BG_LEVEL = 60
+BG_DRIFT = 8  # The amplitude of the slow drift of the background, in gray levels
+BG_DRIFT_PERIOD = 600  # Frames
+NOISE = 6  # The standard deviation of the per-frame noise, in gray levels
+MARGIN = 100  # Track centers are at least this far from the frame edges
+
+
+@dataclass
+class TrackSpec:
+    """
+    The ground truth of a synthetic track, in the coordinates of the source video.
+
+    start (int): The index of the first frame the track appears in
+    lifetime (int): The number of frames the track appears in
+    x (float): The horizontal position of the track's center
+    y (float): The vertical position of the track's center
+    length (float): The length of the track, along its arc
+    width (int): The thickness of the track
+    angle (float): The direction of the track at its center, in radians
+    curvature (float): The inverse of the track's radius (0 for a straight track)
+    brightness (int): How much brighter than the background the track is, in gray levels
+    """
+    start: int
+    lifetime: int
+    x: float
+    y: float
+    length: float
+    width: int
+    angle: float
+    curvature: float
+    brightness: int
+
+    @property
+    def stop(self) -> int:
+        return self.start + self.lifetime
+
+    def points(self, count: int = 50) -> np.ndarray:
+        """
+        Samples points along the track, as an array of (x, y) rows.
+        """
+        arc = np.linspace(-self.length / 2, self.length / 2, count)
+        if self.curvature:
+            along = np.sin(self.curvature * arc) / self.curvature
+            across = (1 - np.cos(self.curvature * arc)) / self.curvature
+        else:
+            along, across = arc, np.zeros_like(arc)
+        direction = np.array([np.cos(self.angle), np.sin(self.angle)])
+        normal = np.array([-np.sin(self.angle), np.cos(self.angle)])
+        return np.array([self.x, self.y]) + np.outer(along, direction) + np.outer(across, normal)
+
+
+def random_tracks(rng: np.random.Generator, frames: int, size: Tuple[int, int], rate: float) -> List[TrackSpec]:
+    """
+    Creates tracks which appear at the given rate (per frame), half of them straight and half curved.
+    """
+    width, height = size
+    tracks = []
+    for start in np.flatnonzero(rng.random(frames) < rate).tolist():
+        length = rng.uniform(80, 300)
+        curved = rng.random() < 0.5
+        tracks.append(TrackSpec(start=start,
+                                lifetime=int(rng.integers(10, 40)),
+                                x=rng.uniform(MARGIN, width - MARGIN),
+                                y=rng.uniform(MARGIN, height - MARGIN),
+                                length=length,
+                                width=int(rng.integers(4, 12)),
+                                angle=rng.uniform(0, np.pi),
+                                curvature=rng.uniform(0.5, 2) / length if curved else 0,
+                                brightness=int(rng.integers(60, 140))))
+    return tracks
+
+
+def _background(index: int, noise: np.ndarray) -> np.ndarray:
+    phase = 2 * np.pi * index / BG_DRIFT_PERIOD
+    drift = BG_LEVEL + BG_DRIFT * np.sin(np.linspace(0, 2 * np.pi, noise.shape[1], dtype=np.float32) + phase)
+    # OpenCV's generator is much faster than numpy's for full frames (it is seeded in `write_footage`)
+    cv.randn(noise, 0, NOISE)
+    return cv.convertScaleAbs(noise + drift)
+
+
+def write_footage(path: Path, frames: int, size: Tuple[int, int] = (1280, 720), fps: int = 30,
+                  rate: float = 0.02, seed: int = 0) -> List[TrackSpec]:
+    """
+    Writes a reproducible synthetic cloud chamber video: a noisy, slowly drifting background with random tracks.
+    The ground truth is saved next to it, with a .json suffix.
+
+    Returns:
+        The tracks in the video
+    """
+    rng = np.random.default_rng(seed)
+    cv.setRNGSeed(seed)
+    tracks = random_tracks(rng, frames, size, rate)
+    noise = np.empty(size[::-1], np.float32)
+    writer = cv.VideoWriter(str(path), cv.VideoWriter_fourcc(*"mp4v"), fps, size)
+    try:
+        for index in range(frames):
+            image = _background(index, noise)
+            for track in tracks:
+                if track.start <= index < track.stop:
+                    points = np.round(track.points()).astype(np.int32)
+                    overlay = np.zeros_like(image)
+                    cv.polylines(overlay, [points], False, track.brightness, track.width, cv.LINE_AA)
+                    image = cv.add(image, overlay)
+            writer.write(cv.cvtColor(image, cv.COLOR_GRAY2BGR))
+    finally:
+        writer.release()
+    path.with_suffix(".json").write_text(json.dumps({"frames": frames, "size": size, "fps": fps, "rate": rate,
+                                                     "seed": seed, "tracks": [asdict(track) for track in tracks]}))
+    return tracks
+
+
+def load_ground_truth(path: Path) -> List[TrackSpec]:
+    return [TrackSpec(**track) for track in json.loads(path.with_suffix(".json").read_text())["tracks"]]
+
+
+def parse_args() -> ap.Namespace:
+    parser = ap.ArgumentParser(description="Write a synthetic cloud chamber video, with its ground truth")
+    parser.add_argument("path", type=Path)
+    parser.add_argument("--frames", type=int, default=1800)
+    parser.add_argument("--size", type=int, nargs=2, default=(1280, 720), metavar=("WIDTH", "HEIGHT"))
+    parser.add_argument("--fps", type=int, default=30)
+    parser.add_argument("--rate", type=float, default=0.02, help="The chance of a new track in each frame")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    tracks = write_footage(args.path, args.frames, tuple(args.size), args.fps, args.rate, args.seed)
+    print(f"Wrote {args.frames} frames with {len(tracks)} tracks to {args.path}")